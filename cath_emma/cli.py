@@ -2,15 +2,25 @@ import logging
 import click
 
 from .commands import calculate_esm_embeddings
+from .commands import consolidate_embeddings
+from .commands import convert_embeddings
 from .commands import convert_fasta_to_csv
 from .commands import qsub_to_embeddings
 from .commands import create_distance_matrix
+from .commands import convert_distance_matrix
+from .commands import create_distance_tiles
+from .commands import merge_distance_tiles
 from .commands import create_starting_clusters
+from .commands import create_label_index
+from .commands import build_tree
+from .commands import cut_tree
+from .commands import build_partitioned_tree
 from .commands import populate_centroids
 from .commands import qsub_embeddings_to_emma_input
 from .commands import qsub_run_mmseqs2
 from .commands import qsub_emma
 from .commands import qsub_populate_clusters
+from .commands import qsub_distance_tiles
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
@@ -35,13 +45,22 @@ def cli(ctx, verbosity):
 
 
 cli.add_command(calculate_esm_embeddings.calculate_esm_to_embed)
+cli.add_command(consolidate_embeddings.consolidate_embeddings)
+cli.add_command(convert_embeddings.convert_embeddings)
 cli.add_command(convert_fasta_to_csv.convert_fasta_to_csv_for_embed)
 cli.add_command(qsub_to_embeddings.qsub_to_embeddings)
 cli.add_command(create_distance_matrix.create_distance_matrix)
+cli.add_command(convert_distance_matrix.convert_distance_matrix)
+cli.add_command(create_distance_tiles.create_distance_tiles)
+cli.add_command(merge_distance_tiles.merge_distance_tiles)
 cli.add_command(create_starting_clusters.create_starting_clusters_from_centroids)
+cli.add_command(create_label_index.create_label_index)
+cli.add_command(build_tree.build_tree)
+cli.add_command(cut_tree.cut_tree)
+cli.add_command(build_partitioned_tree.build_partitioned_tree)
 cli.add_command(populate_centroids.populate_cluster_centroids)
 cli.add_command(qsub_embeddings_to_emma_input.qsub_embeddings_to_emma_input)
 cli.add_command(qsub_run_mmseqs2.qsub_to_mmseqs2)
 cli.add_command(qsub_emma.qsub_emma_input_to_emma_output)
 cli.add_command(qsub_populate_clusters.qsub_emma_to_ff_input)
-
+cli.add_command(qsub_distance_tiles.qsub_distance_tiles)
@@ -0,0 +1,131 @@
+import click
+import logging
+import torch
+from ..label_index import LabelIndex
+from ..partitioning import (
+    DEFAULT_KMEANS_BATCH_SIZE,
+    DEFAULT_KMEANS_ITERATIONS,
+    DEFAULT_MAX_PARTITION_SIZE,
+    partitioned_linkage,
+)
+from ..tree_builder import LINKAGES
+from .build_tree import write_merge_node_alignments, write_tree
+from .create_distance_matrix import load_embedding_matrix
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
+)
+
+LOG = logging.getLogger(__name__)
+
+
+@click.command()
+@click.option(
+    "--input_to_process",
+    type=str,
+    required=True,
+    help="Input: PT file or embedding store (.npy) from ESM embeddings",
+)
+@click.option(
+    "--labels_file",
+    type=click.File("rt"),
+    required=True,
+    help="Input: Label index of the project (see create-label-index). Starting cluster working_N is the label with id N-1.",
+)
+@click.option(
+    "--embedding_distance",
+    type=click.Choice(["cosine", "euclidean"]),
+    default="euclidean",
+    help="Parameter: Embedding distance metric. (default: euclidean)",
+)
+@click.option(
+    "--linkage",
+    type=click.Choice(LINKAGES),
+    default="average",
+    help="Parameter: Linkage used to merge clusters (default: average)",
+)
+@click.option(
+    "--max_partition_size",
+    type=int,
+    default=DEFAULT_MAX_PARTITION_SIZE,
+    help=f"Parameter: Maximum number of labels per partition, each getting an exact distance matrix and tree (default: {DEFAULT_MAX_PARTITION_SIZE}, i.e. 1.6 GB of distances)",
+)
+@click.option(
+    "--kmeans_batch_size",
+    type=int,
+    default=DEFAULT_KMEANS_BATCH_SIZE,
+    help=f"Parameter: Embeddings sampled per mini-batch k-means iteration (default: {DEFAULT_KMEANS_BATCH_SIZE})",
+)
+@click.option(
+    "--kmeans_iterations",
+    type=int,
+    default=DEFAULT_KMEANS_ITERATIONS,
+    help=f"Parameter: Mini-batch k-means iterations per split (default: {DEFAULT_KMEANS_ITERATIONS})",
+)
+@click.option(
+    "--seed",
+    type=int,
+    default=2023,
+    help="Parameter: Seed of the k-means initialisation and mini-batches (default: 2023)",
+)
+@click.option(
+    "--processes",
+    type=int,
+    default=1,
+    help="Parameter: Number of worker processes building partition trees in parallel (default: 1)",
+)
+@click.option(
+    "--tree_dir",
+    type=click.Path(file_okay=False, dir_okay=True),
+    required=True,
+    help="Output: GeMMA tree directory for tree.trace and tree.newick (i.e. --centroids_tree_dir of populate-cluster-centroids)",
+)
+@click.option(
+    "--partitions_file",
+    type=click.File("wt"),
+    default=None,
+    help="Output: Partition of each label, as 'label<TAB>partition' lines (-1 for labels without embedding)",
+)
+@click.option(
+    "--cluster_reps_file",
+    type=click.File("rt"),
+    default=None,
+    help="Input: CSV file of cluster representatives in ID,FASTA format, to also write merge_node_alignments (example: ${PROJECT}_reps.csv)",
+)
+def build_partitioned_tree(
+    input_to_process,
+    labels_file,
+    embedding_distance,
+    linkage,
+    max_partition_size,
+    kmeans_batch_size,
+    kmeans_iterations,
+    seed,
+    processes,
+    tree_dir,
+    partitions_file,
+    cluster_reps_file,
+):
+    """Build the eMMA tree of a large project from exact trees of k-means partitions"""
+    label_index = LabelIndex.read(labels_file)
+    matrix, positions = load_embedding_matrix(
+        input_to_process, label_index.labels, torch.device("cpu")
+    )
+    trace, partition_of_label = partitioned_linkage(
+        matrix,
+        positions,
+        metric=embedding_distance,
+        linkage=linkage,
+        max_size=max_partition_size,
+        processes=processes,
+        batch_size=kmeans_batch_size,
+        iterations=kmeans_iterations,
+        seed=seed,
+    )
+    write_tree(tree_dir, trace)
+    if partitions_file:
+        for label, partition in zip(label_index.labels, partition_of_label.tolist()):
+            partitions_file.write(f"{label}\t{partition}\n")
+    if cluster_reps_file:
+        write_merge_node_alignments(tree_dir, trace, label_index, cluster_reps_file)
+    LOG.info("DONE")
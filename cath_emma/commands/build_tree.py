@@ -0,0 +1,146 @@
+import os
+import click
+import logging
+from ..io_utils import save_atomic
+from ..label_index import LabelIndex
+from ..merge_trace import NEWICK_FILE, TRACE_FILE
+from ..tree_builder import (
+    DEFAULT_MERGE_WINDOW,
+    LINKAGES,
+    TREE_BUILDERS,
+    build_linkage,
+    load_binary_matrix,
+    load_ssv_graph,
+    load_ssv_matrix,
+    sparse_linkage,
+)
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
+)
+
+LOG = logging.getLogger(__name__)
+
+
+def write_tree(tree_dir, trace):
+    """Write tree.trace and tree.newick of a merge trace into a GeMMA tree directory"""
+    os.makedirs(tree_dir, exist_ok=True)
+
+    def save_trace(path):
+        with open(path, "wt") as trace_fh:
+            trace.write(trace_fh)
+
+    def save_newick(path):
+        with open(path, "wt") as newick_fh:
+            trace.write_newick(newick_fh)
+
+    save_atomic(os.path.join(tree_dir, TRACE_FILE), save_trace)
+    save_atomic(os.path.join(tree_dir, NEWICK_FILE), save_newick)
+    LOG.info(f"Wrote {len(trace)} merges -> {tree_dir}/{TRACE_FILE}")
+
+
+def write_merge_node_alignments(tree_dir, trace, label_index, cluster_reps_fh):
+    """Write the cluster representatives under each merge node as <node>.faa"""
+    sequences = {}
+    for line in cluster_reps_fh:
+        if not line.strip():
+            continue
+        label, sequence = line.rstrip().split(",", 1)
+        sequences[label] = sequence
+    alignments_dir = os.path.join(tree_dir, "merge_node_alignments")
+    os.makedirs(alignments_dir, exist_ok=True)
+    for node, leaves in trace.iter_merge_members():
+        with open(os.path.join(alignments_dir, f"{node}.faa"), "wt") as alignment_fh:
+            for leaf in leaves:
+                label = label_index.label_of(leaf - 1)
+                alignment_fh.write(f">{label}\n{sequences[label]}\n")
+    LOG.info(f"Wrote {len(trace)} merge node alignments -> {alignments_dir}")
+
+
+@click.command()
+@click.option(
+    "--distance_matrix",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    required=True,
+    help="Input: Distance matrix from create-distance-matrix, SSV text (optionally .gz/.zst) or binary",
+)
+@click.option(
+    "--matrix_format",
+    type=click.Choice(["ssv", "binary"]),
+    default="ssv",
+    help="Parameter: Format of the distance matrix (default: ssv)",
+)
+@click.option(
+    "--labels_file",
+    type=click.File("rt"),
+    default=None,
+    help="Input: Label index used to create the matrix (see create-label-index). Starting cluster working_N is the label with id N-1. (required for SSV matrices, default: the <matrix>.labels of a binary matrix)",
+)
+@click.option(
+    "--linkage",
+    type=click.Choice(LINKAGES),
+    default="average",
+    help="Parameter: Linkage used to merge clusters (default: average)",
+)
+@click.option(
+    "--tree_builder",
+    type=click.Choice(TREE_BUILDERS),
+    default="nn_chain",
+    help="Parameter: Nearest-neighbour chain (one merge at a time), windowed (several reciprocal nearest pairs merged per round, same tree) or sparse (SSV neighbour file from create-distance-matrix --neighbours, memory proportional to the listed pairs) (default: nn_chain)",
+)
+@click.option(
+    "--merge_window",
+    type=int,
+    default=DEFAULT_MERGE_WINDOW,
+    help=f"Parameter: Closest candidate pairs considered per round of the windowed builder (default: {DEFAULT_MERGE_WINDOW})",
+)
+@click.option(
+    "--tree_dir",
+    type=click.Path(file_okay=False, dir_okay=True),
+    required=True,
+    help="Output: GeMMA tree directory for tree.trace and tree.newick (i.e. --centroids_tree_dir of populate-cluster-centroids)",
+)
+@click.option(
+    "--cluster_reps_file",
+    type=click.File("rt"),
+    default=None,
+    help="Input: CSV file of cluster representatives in ID,FASTA format, to also write merge_node_alignments (example: ${PROJECT}_reps.csv)",
+)
+def build_tree(
+    distance_matrix,
+    matrix_format,
+    labels_file,
+    linkage,
+    tree_builder,
+    merge_window,
+    tree_dir,
+    cluster_reps_file,
+):
+    """Build the eMMA tree of a project from its distance matrix"""
+    if matrix_format == "binary":
+        if tree_builder == "sparse":
+            raise click.UsageError("--tree_builder sparse reads SSV neighbour files")
+        label_index, distances = load_binary_matrix(distance_matrix)
+        if labels_file:
+            LOG.warning(f"Using the labels of {distance_matrix}, ignoring --labels_file")
+    else:
+        if labels_file is None:
+            raise click.UsageError("--labels_file is required for SSV matrices")
+        label_index = LabelIndex.read(labels_file)
+    LOG.info(
+        f"Building {linkage} linkage tree ({tree_builder}) of {len(label_index)} starting clusters from {distance_matrix}"
+    )
+    if tree_builder == "sparse":
+        rows, cols, distances = load_ssv_graph(distance_matrix, label_index)
+        trace = sparse_linkage(len(label_index), rows, cols, distances, linkage)
+    else:
+        if matrix_format == "ssv":
+            distances = load_ssv_matrix(distance_matrix, label_index)
+        trace = build_linkage(
+            distances, len(label_index), linkage, tree_builder, merge_window
+        )
+    del distances
+    write_tree(tree_dir, trace)
+    if cluster_reps_file:
+        write_merge_node_alignments(tree_dir, trace, label_index, cluster_reps_file)
+    LOG.info("DONE")
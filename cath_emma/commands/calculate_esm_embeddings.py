@@ -1,30 +1,119 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-import esm
 import torch
 import click
-from torch.utils.data import DataLoader, Dataset
-from tqdm import tqdm
-import os
+from ..embedding_cache import EmbeddingCache
+from ..embedding_shards import (
+    DEFAULT_SHARD_SIZE,
+    consolidate_shards,
+    open_manifest,
+    shard_ranges,
+    write_shard,
+)
+from ..embedding_store import (
+    EmbeddingStoreWriter,
+    embeddings_exist,
+    is_embedding_store,
+    pt_vector,
+    write_embedding_store,
+)
+from ..esm_inference import (
+    DEFAULT_REPR_LAYER,
+    ESM_MODELS,
+    POOLINGS,
+    PRECISIONS,
+    SequenceEmbedder,
+)
+from ..io_utils import save_atomic
+from ..matrix_io import MATRIX_DTYPES
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
+)
+
+LOG = logging.getLogger(__name__)
 
 
 @click.command()
 @click.option(
     "--input_sequence_csv",
     type=click.File("rt"),
-    required=True,
+    default=None,
     help="Input: CSV file containing protein sequences in the format 'label,sequence'",
 )
+@click.option(
+    "--input_list",
+    type=click.File("rt"),
+    default=None,
+    help="Input: File of 'sequence_csv embeddings_output' lines, one per project, embedded in turn with the model loaded once; projects whose output exists are skipped",
+)
 @click.option(
     "--esm_model",
-    type=click.Choice(["esm1v", "esm1b", "esm2_3b", "esm2", "esm2_15b"]),
+    type=click.Choice(list(ESM_MODELS)),
     default="esm2",
     help=f"ESM model used to generate embeddings (default: ESM2)",
 )
 @click.option(
     "--embeddings_output",
-    type=click.File("wb"),
-    required=True,
-    help=f"Output: Torch .pt file with embeddings",
+    type=click.Path(file_okay=True, dir_okay=False),
+    default=None,
+    help=f"Output: Torch .pt file with embeddings, or an embedding store if it ends with .npy (required unless --shard_dir is used)",
+)
+@click.option(
+    "--repr_layer",
+    type=int,
+    default=DEFAULT_REPR_LAYER,
+    help=f"Parameter: Layer whose representations are pooled; the model only runs up to this layer (default: {DEFAULT_REPR_LAYER})",
+)
+@click.option(
+    "--precision",
+    type=click.Choice(PRECISIONS),
+    default="fp32",
+    help="Parameter: Inference precision, float32, bfloat16 autocast or dynamic int8 quantization of the linear layers (CPU only) (default: fp32)",
+)
+@click.option(
+    "--precision_check",
+    type=int,
+    default=0,
+    help="Parameter: Before embedding, report the drift of embeddings and pairwise distances against fp32 on this many sampled sequences (default: 0, no check)",
+)
+@click.option(
+    "--pipeline_threads",
+    type=int,
+    default=0,
+    help="Parameter: Pipeline the run with this many tokenizer threads, a background CSV reader streaming chunks of --shard_size rows and a background shard writer, so the model never waits on parsing or disk. An .npy --embeddings_output is written chunk by chunk, a .pt one is held in memory until the end (default: 0, off)",
+)
+@click.option(
+    "--processes",
+    type=int,
+    default=1,
+    help="Parameter: Number of worker processes embedding batches in parallel on the CPU, sharing the model weights (default: 1)",
+)
+@click.option(
+    "--threads_per_process",
+    type=int,
+    default=None,
+    help="Parameter: Number of torch threads of each worker process (default: CPU cores / processes)",
+)
+@click.option(
+    "--pin_threads",
+    is_flag=True,
+    default=False,
+    help="Parameter: Pin each worker process to its own threads_per_process cores",
+)
+@click.option(
+    "--window_size",
+    type=int,
+    default=None,
+    help="Parameter: Embed sequences longer than this many residues in overlapping windows, i.e. 1022 for the ESM context (default: off)",
+)
+@click.option(
+    "--window_overlap",
+    type=int,
+    default=256,
+    help="Parameter: Number of residues shared by consecutive windows (default: 256)",
 )
 @click.option(
     "--batch_size",
@@ -32,93 +121,321 @@ import os
     default=2,
     help=f"Change value to determine how many embeddings to generate for each round (default: 2).",
 )
+@click.option(
+    "--max_tokens",
+    type=int,
+    default=None,
+    help="Parameter: Sort sequences by length and pack batches up to this number of padded tokens instead of --batch_size sequences in input order (default: off)",
+)
+@click.option(
+    "--pooling",
+    type=click.Choice(POOLINGS),
+    default="residue_mean",
+    help="Parameter: Mean over residue tokens only, or over all tokens including BOS/EOS and padding as in earlier versions (default: residue_mean)",
+)
+@click.option(
+    "--embedding_cache",
+    type=click.Path(file_okay=True, dir_okay=False),
+    default=None,
+    help="Input/Output: SQLite cache of embeddings keyed by model, layer, pooling and sequence md5; only uncached sequences are embedded (default: no cache)",
+)
+@click.option(
+    "--cache_max_gb",
+    type=float,
+    default=None,
+    help="Parameter: Evict the least recently used cached embeddings beyond this size in GB (default: unbounded)",
+)
+@click.option(
+    "--shard_dir",
+    type=click.Path(file_okay=False, dir_okay=True),
+    default=None,
+    help="Output: Directory of embedding shards written as they are computed, with a manifest of completed labels; a rerun resumes from the completed shards (see consolidate-embeddings)",
+)
+@click.option(
+    "--shard_size",
+    type=int,
+    default=DEFAULT_SHARD_SIZE,
+    help=f"Parameter: Number of sequences per embedding shard, and per chunk streamed by pipelined runs (default: {DEFAULT_SHARD_SIZE})",
+)
+@click.option(
+    "--embeddings_dtype",
+    type=click.Choice(list(MATRIX_DTYPES)),
+    default="float32",
+    help="Parameter: Float type of an embedding store output (default: float32)",
+)
 def calculate_esm_to_embed(
-    input_sequence_csv, esm_model, embeddings_output, batch_size
+    input_sequence_csv,
+    input_list,
+    esm_model,
+    embeddings_output,
+    repr_layer,
+    precision,
+    precision_check,
+    pipeline_threads,
+    processes,
+    threads_per_process,
+    pin_threads,
+    window_size,
+    window_overlap,
+    batch_size,
+    max_tokens,
+    pooling,
+    embedding_cache,
+    cache_max_gb,
+    shard_dir,
+    shard_size,
+    embeddings_dtype,
 ):
     """Calculate embeddings for an input csv file containing sequences and labels using ESM2"""
+    if (input_sequence_csv is None) == (input_list is None):
+        raise click.UsageError("Either --input_sequence_csv or --input_list is required")
+    if input_list is not None and (
+        embeddings_output is not None or shard_dir is not None
+    ):
+        raise click.UsageError(
+            "--input_list gives the output of each project, without --embeddings_output or --shard_dir"
+        )
+    if input_list is None and embeddings_output is None and shard_dir is None:
+        raise click.UsageError("Either --embeddings_output or --shard_dir is required")
+    if input_list is not None:
+        projects = read_input_list(input_list)
+        if not projects:
+            raise click.UsageError(f"No projects listed in {input_list.name}")
+    if window_size is not None:
+        if not 0 <= window_overlap < window_size:
+            raise click.BadParameter(
+                "The overlap must be smaller than the window size",
+                param_hint="--window_overlap",
+            )
+        if pooling != "residue_mean":
+            raise click.BadParameter(
+                "Windows are pooled over residues", param_hint="--pooling"
+            )
     if torch.cuda.is_available():
         SEED = 2023
         device = torch.device("cuda")
         torch.cuda.manual_seed(SEED)
         print(f"There are {torch.cuda.device_count()} GPU(s) available.")
         print("Device name:", torch.cuda.get_device_name(0))
-        print(f"Processing: {input_sequence_csv.name}")
     else:
         print("No GPU available, using the CPU instead.")
         device = torch.device("cpu")
-    path_to_csv = input_sequence_csv
-
-    df = pd.read_csv(path_to_csv, names=["label", "sequence"])
-
-    batch_size = 2  # you can change here to determine how many embeddings to generate for each round.
-
-    model_selection = esm_model
-
-    if model_selection == "esm1v":
-        model, alphabet = esm.pretrained.esm1v_t33_650M_UR90S_1()  # can run on 12GB GPU
-    elif model_selection == "esm1b":
-        model, alphabet = esm.pretrained.esm1b_t33_650M_UR50S()  # can run on 12GB GPU
-    elif model_selection == "esm2":
-        model, alphabet = esm.pretrained.esm2_t33_650M_UR50D()  # can run on 12GB GPU
-    elif model_selection == "esm2_3b":
-        model, alphabet = esm.pretrained.esm2_t36_3B_UR50D()  # can run on 24GB GPU
-    elif model_selection == "esm2_15b":
-        (
-            model,
-            alphabet,
-        ) = (
-            esm.pretrained.esm2_t48_15B_UR50D()
-        )  # not possible to run on the cluster, too large
-
-    batch_converter = alphabet.get_batch_converter()
-    model = model.to(device)  # move the model to GPU
-
-    dataset = ESMDataset(df)
-    data_loader = DataLoader(
-        dataset,
+    if precision == "int8" and device.type != "cpu":
+        LOG.warning("Dynamic int8 quantization runs on the CPU only, using the CPU")
+        device = torch.device("cpu")
+    if processes > 1 and device.type != "cpu":
+        LOG.warning("Worker processes embed on the CPU only, using one process")
+        processes = 1
+    # embeddings of another precision or windowing are cached under their own keys
+    model_key = esm_model if precision == "fp32" else f"{esm_model}-{precision}"
+    pooling_key = pooling
+    if window_size is not None:
+        pooling_key = f"{pooling}-window{window_size}-overlap{window_overlap}"
+
+    cache = None
+    if embedding_cache is not None:
+        cache = EmbeddingCache(
+            embedding_cache,
+            model_key,
+            repr_layer,
+            pooling_key,
+            max_bytes=None if cache_max_gb is None else int(cache_max_gb * 1024**3),
+        )
+    embedder = SequenceEmbedder(
+        esm_model,
+        device,
+        pooling=pooling,
         batch_size=batch_size,
-        shuffle=False,
-        collate_fn=collate_fn,
-        drop_last=False,
+        max_tokens=max_tokens,
+        cache=cache,
+        repr_layer=repr_layer,
+        precision=precision,
+        tokenizer_threads=pipeline_threads,
+        processes=processes,
+        threads_per_process=threads_per_process,
+        pin_threads=pin_threads,
+        window_size=window_size,
+        window_overlap=window_overlap,
+    )
+
+    # shards and pipelined runs stream the input in chunks of shard_size rows
+    streamed = shard_dir is not None or pipeline_threads > 0
+    if input_list is None and not streamed:
+        LOG.info(f"Processing: {input_sequence_csv.name}")
+        df = pd.read_csv(input_sequence_csv, names=["label", "sequence"])
+
+    if precision_check and precision != "fp32":
+        if input_list is not None:
+            # sample the first project
+            df = pd.read_csv(projects[0][0], names=["label", "sequence"])
+        elif streamed:
+            # sample the first chunk
+            df = pd.read_csv(
+                input_sequence_csv.name, names=["label", "sequence"], nrows=shard_size
+            )
+        report_precision_drift(embedder, df, precision_check)
+
+    if input_list is not None:
+        embed_projects(embedder, projects, embeddings_dtype)
+    elif not streamed:
+        embeddings = embedder.embed(list(df["label"]), list(df["sequence"]))
+        # save the embeddings in input order
+        write_embeddings(embeddings, embeddings_output, embeddings_dtype)
+    elif shard_dir is None:
+        LOG.info(f"Streaming: {input_sequence_csv.name}")
+        chunks = iter_csv_chunks(input_sequence_csv, shard_size)
+        if is_embedding_store(embeddings_output):
+            stream_embedding_store(
+                embedder, input_sequence_csv, chunks, embeddings_output, embeddings_dtype
+            )
+        else:
+            embeddings = [
+                embedding
+                for chunk_embeddings in embedder.iter_embed_chunks(chunks)
+                for embedding in chunk_embeddings
+            ]
+            write_embeddings(embeddings, embeddings_output, embeddings_dtype)
+    else:
+        embed_to_shards(
+            embedder,
+            input_sequence_csv,
+            shard_dir,
+            shard_size,
+            {"esm_model": model_key, "repr_layer": repr_layer, "pooling": pooling_key},
+            background_writer=pipeline_threads > 0,
+        )
+        if embeddings_output is not None:
+            consolidate_shards(
+                shard_dir,
+                embeddings_output,
+                "npy" if is_embedding_store(embeddings_output) else "pt",
+                embeddings_dtype,
+            )
+    embedder.close()
+    if cache is not None:
+        cache.close()
+
+
+def iter_csv_chunks(input_sequence_csv, chunk_size):
+    """Yield (labels, sequences) of consecutive chunks of chunk_size CSV rows"""
+    for chunk in pd.read_csv(
+        input_sequence_csv, names=["label", "sequence"], chunksize=chunk_size
+    ):
+        yield list(chunk["label"]), list(chunk["sequence"])
+
+
+def stream_embedding_store(embedder, input_sequence_csv, chunks, store_path, dtype):
+    """Write the embeddings of streamed chunks into an embedding store as they are computed
+
+    Only the labels of the CSV are read upfront, to size the store.
+    """
+    labels = pd.read_csv(
+        input_sequence_csv.name, names=["label", "sequence"], usecols=["label"]
+    )["label"]
+    writer = EmbeddingStoreWriter(store_path, list(labels), dtype)
+    for chunk_embeddings in embedder.iter_embed_chunks(chunks):
+        for embedding in chunk_embeddings:
+            writer.write(pt_vector(embedding))
+    writer.close()
+
+
+def embed_to_shards(
+    embedder, input_sequence_csv, shard_dir, shard_size, layout, background_writer
+):
+    """Embed the CSV shard by shard, skipping the shards completed by a previous run
+
+    The CSV is streamed, so it does not need to fit in memory. With a background
+    writer each shard is saved while the next one is embedded.
+    """
+    LOG.info(f"Streaming: {input_sequence_csv.name}")
+    n_sequences = sum(
+        len(labels) for labels, _ in iter_csv_chunks(input_sequence_csv.name, shard_size)
+    )
+    manifest = open_manifest(
+        shard_dir,
+        {
+            "input_sequence_csv": os.path.basename(input_sequence_csv.name),
+            "n_sequences": n_sequences,
+            "shard_size": shard_size,
+            **layout,
+        },
+    )
+    n_shards = len(shard_ranges(n_sequences, shard_size))
+    todo = [shard for shard in range(n_shards) if str(shard) not in manifest["shards"]]
+    LOG.info(f"{len(todo)} of {n_shards} shards left to embed -> {shard_dir}")
+    chunks = (
+        chunk
+        for shard, chunk in enumerate(iter_csv_chunks(input_sequence_csv, shard_size))
+        if str(shard) not in manifest["shards"]
+    )
+    writer = ThreadPoolExecutor(max_workers=1) if background_writer else None
+    written = None
+    for shard, embeddings in zip(todo, embedder.iter_embed_chunks(chunks)):
+        if writer is None:
+            write_shard(shard_dir, manifest, shard, embeddings)
+            continue
+        if written is not None:
+            written.result()
+        written = writer.submit(write_shard, shard_dir, manifest, shard, embeddings)
+    if writer is not None:
+        if written is not None:
+            written.result()
+        writer.shutdown()
+
+
+def report_precision_drift(embedder, df, n_sample):
+    drift = embedder.check_precision(list(df["label"]), list(df["sequence"]), n_sample)
+    LOG.info(
+        f"{embedder.precision} vs fp32 embeddings relative error: median {drift['median_relative_error']:.2e}, max {drift['max_relative_error']:.2e}"
     )
+    for metric, distortion in drift["distances"].items():
+        LOG.info(
+            f"{embedder.precision} vs fp32 {metric} distances: "
+            f"median relative error {distortion['median_relative_error']:.2e}, "
+            f"95th percentile {distortion['p95_relative_error']:.2e}, "
+            f"Spearman {distortion['spearman']:.4f}"
+        )
+
+
+def embed_projects(embedder, projects, embeddings_dtype):
+    """Embed the (sequence_csv, embeddings_output) projects in turn with one model"""
+    LOG.info(f"Embedding {len(projects)} projects")
+    for project_csv, project_output in projects:
+        if embeddings_exist(project_output):
+            LOG.info(f"Skipping {project_csv}: {project_output} exists")
+            continue
+        LOG.info(f"Processing: {project_csv}")
+        df = pd.read_csv(project_csv, names=["label", "sequence"])
+        embeddings = embedder.embed(list(df["label"]), list(df["sequence"]))
+        write_embeddings(embeddings, project_output, embeddings_dtype)
+        LOG.info(f"Wrote {len(embeddings)} embeddings -> {project_output}")
+
+
+def read_input_list(input_list):
+    """(sequence_csv, embeddings_output) of each non-empty line of an input list"""
+    projects = []
+    for line in input_list:
+        fields = line.split()
+        if not fields:
+            continue
+        if len(fields) != 2:
+            raise click.BadParameter(
+                f"Expected 'sequence_csv embeddings_output', got: {line.strip()}",
+                param_hint="--input_list",
+            )
+        projects.append(tuple(fields))
+    return projects
+
+
+def write_embeddings(embeddings, embeddings_output, embeddings_dtype):
+    if is_embedding_store(embeddings_output):
+        write_embedding_store(embeddings_output, embeddings, embeddings_dtype)
+    else:
+
+        def save_embeddings(path):
+            with open(path, "wb") as embeddings_fh:
+                torch.save(
+                    embeddings, embeddings_fh
+                )  # length of the dataset, embedding_size, e.g. (140000, 1280)
 
-    embeddings = []
-    for i in tqdm(data_loader):
-        batch_labels, batch_strs, batch_tokens = batch_converter(i)
-        with torch.no_grad():
-            results = model(batch_tokens.to(device), repr_layers=[33])[
-                "representations"
-            ][
-                33
-            ]  # batch_size, max_seq_len, embedding_size
-            avg_x = torch.mean(
-                results, dim=1
-            )  # average the embedding for each sequence -> batch_size, embedding_size
-            for j in range(len(batch_labels)):
-                embeddings.append(
-                    {"label": batch_labels[j], "mean_representations": {33: avg_x[j]}}
-                )
-
-    # save the embeddings
-    torch.save(
-        embeddings, embeddings_output
-    )  # length of the dataset, embedding_size, e.g. (140000, 1280)
-
-
-# prepare dataset for ESM
-class ESMDataset(Dataset):
-    def __init__(self, row):
-        super().__init__()
-        self.seq = row["sequence"]
-        self.label = row["label"]
-
-    def __len__(self):
-        return len(self.seq)
-
-    def __getitem__(self, idx):
-        return (self.label[idx], self.seq[idx])
-
-
-def collate_fn(batch):
-    labels, sequences = zip(*batch)
-    return list(zip(labels, sequences))
+        save_atomic(embeddings_output, save_embeddings)
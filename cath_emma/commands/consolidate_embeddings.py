@@ -0,0 +1,47 @@
+import click
+import logging
+from ..embedding_shards import consolidate_shards
+from ..embedding_store import EMBEDDING_FORMATS
+from ..matrix_io import MATRIX_DTYPES
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
+)
+
+LOG = logging.getLogger(__name__)
+
+
+@click.command()
+@click.option(
+    "--shard_dir",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True),
+    required=True,
+    help="Input: Directory of embedding shards written by calculate-esm-to-embed --shard_dir",
+)
+@click.option(
+    "--embeddings_output",
+    type=click.Path(file_okay=True, dir_okay=False),
+    required=True,
+    help="Output: Embeddings file",
+)
+@click.option(
+    "--embeddings_format",
+    type=click.Choice(EMBEDDING_FORMATS),
+    default="pt",
+    help="Parameter: Torch .pt list of embeddings, or an embedding store, i.e. a memory-mappable .npy array with a <output>.labels index (default: pt)",
+)
+@click.option(
+    "--embeddings_dtype",
+    type=click.Choice(list(MATRIX_DTYPES)),
+    default="float32",
+    help="Parameter: Float type of the embedding store (default: float32)",
+)
+def consolidate_embeddings(
+    shard_dir, embeddings_output, embeddings_format, embeddings_dtype
+):
+    """Combine the embedding shards of calculate-esm-to-embed into one file"""
+    n_embeddings = consolidate_shards(
+        shard_dir, embeddings_output, embeddings_format, embeddings_dtype
+    )
+    LOG.info(f"Wrote {n_embeddings} embeddings -> {embeddings_output}")
+    LOG.info("DONE")
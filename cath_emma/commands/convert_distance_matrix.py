@@ -0,0 +1,53 @@
+import click
+import logging
+from ..distance_engine import DEFAULT_TILE_SIZE
+from ..matrix_io import CondensedDistanceMatrix, MATRIX_COMPRESSIONS, SsvMatrixWriter
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
+)
+
+LOG = logging.getLogger(__name__)
+
+
+@click.command()
+@click.option(
+    "--binary_matrix",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    required=True,
+    help="Input: Condensed binary matrix written by create-distance-matrix --matrix_format binary",
+)
+@click.option(
+    "--matrix_output_file",
+    type=click.Path(file_okay=True, dir_okay=False),
+    required=True,
+    help="Output: Distance matrix in the legacy SSV format (i.e. for prepare_research_data.pl --embs-file)",
+)
+@click.option(
+    "--matrix_compression",
+    type=click.Choice(MATRIX_COMPRESSIONS),
+    default="none",
+    help="Parameter: Stream the SSV matrix through a gzip or zstd compressor (default: none)",
+)
+@click.option(
+    "--writer_processes",
+    type=int,
+    default=1,
+    help="Parameter: Number of worker processes formatting the SSV matrix (default: 1)",
+)
+def convert_distance_matrix(
+    binary_matrix, matrix_output_file, matrix_compression, writer_processes
+):
+    """Convert a binary condensed distance matrix into the legacy SSV text matrix"""
+    matrix = CondensedDistanceMatrix(binary_matrix)
+    LOG.info(f"Converting {len(matrix)}x{len(matrix)} matrix: {binary_matrix}")
+    matrix_writer = SsvMatrixWriter(
+        matrix_output_file,
+        matrix.labels,
+        processes=writer_processes,
+        compression=matrix_compression,
+    )
+    for start, band in matrix.iter_row_bands(DEFAULT_TILE_SIZE):
+        matrix_writer.write_band(start, band)
+    matrix_writer.close()
+    LOG.info("DONE")
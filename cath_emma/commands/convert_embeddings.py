@@ -0,0 +1,38 @@
+import click
+import logging
+import torch
+from ..embedding_store import write_embedding_store
+from ..matrix_io import MATRIX_DTYPES
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
+)
+
+LOG = logging.getLogger(__name__)
+
+
+@click.command()
+@click.option(
+    "--embeddings_input",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    required=True,
+    help="Input: PT file from ESM embeddings",
+)
+@click.option(
+    "--embeddings_output",
+    type=click.Path(file_okay=True, dir_okay=False),
+    required=True,
+    help="Output: Embedding store, i.e. a memory-mappable .npy array with a <output>.labels index",
+)
+@click.option(
+    "--embeddings_dtype",
+    type=click.Choice(list(MATRIX_DTYPES)),
+    default="float32",
+    help="Parameter: Float type of the embedding store (default: float32)",
+)
+def convert_embeddings(embeddings_input, embeddings_output, embeddings_dtype):
+    """Convert a .pt file of ESM embeddings into a memory-mapped embedding store"""
+    with open(embeddings_input, "rb") as embedding_fh:
+        embeddings = torch.load(embedding_fh, map_location="cpu")
+    write_embedding_store(embeddings_output, embeddings, embeddings_dtype)
+    LOG.info("DONE")
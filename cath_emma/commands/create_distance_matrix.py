@@ -3,6 +3,24 @@ import os
 import numpy as np
 import click
 import logging
+from ..distance_engine import (
+    BlockedDistanceEngine,
+    DEFAULT_TILE_SIZE,
+    embedding_hashes,
+    stack_embeddings,
+)
+from ..dim_reduction import REDUCTIONS, distance_distortion, reduce_embeddings
+from ..embedding_store import EmbeddingStore, is_embedding_store
+from ..foldseek import FoldseekHits
+from ..label_index import LabelIndex
+from ..matrix_io import (
+    CondensedDistanceMatrix,
+    MATRIX_COMPRESSIONS,
+    MATRIX_DTYPES,
+    metadata_path_of,
+    open_matrix_writer,
+    write_sparse_ssv,
+)
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
@@ -21,26 +39,106 @@ LOG = logging.getLogger(__name__)
 @click.option(
     "--input_to_process",
     type=str,
-    help="Input: PT file from ESM embeddings or Foldseek ouput",
+    help="Input: PT file or embedding store (.npy) from ESM embeddings, or Foldseek ouput",
     required=True,
 )
 @click.option(
     "--embedding_distance",
     type=click.Choice(["cosine", "euclidean"]),
-    help="Parameter: Embedding distance metric. (default: euclidean)",
-    default="euclidean",
+    multiple=True,
+    help="Parameter: Embedding distance metric, repeat to compute several matrices in one pass. (default: euclidean)",
+    default=["euclidean"],
 )
 @click.option(
     "--matrix_output_file",
-    type=click.File("wt"),
+    type=click.Path(file_okay=True, dir_okay=False),
+    multiple=True,
     required=True,
-    help="Output: Distance matrix file for eMMA input",
+    help="Output: Distance matrix file for eMMA input, one per --embedding_distance in the same order",
+)
+@click.option(
+    "--matrix_format",
+    type=click.Choice(["ssv", "binary"]),
+    default="ssv",
+    help="Parameter: Output format, legacy '>label1 >label2 dist' text or a memory-mapped condensed .npy array with a <matrix>.labels index (default: ssv)",
+)
+@click.option(
+    "--matrix_dtype",
+    type=click.Choice(list(MATRIX_DTYPES)),
+    default="float32",
+    help="Parameter: Float type of the binary matrix (default: float32)",
+)
+@click.option(
+    "--matrix_compression",
+    type=click.Choice(MATRIX_COMPRESSIONS),
+    default="none",
+    help="Parameter: Stream the SSV matrix through a gzip or zstd compressor (default: none)",
+)
+@click.option(
+    "--writer_processes",
+    type=int,
+    default=1,
+    help="Parameter: Number of worker processes formatting the SSV matrix (default: 1)",
 )
 @click.option(
     "--labels_file",
     type=click.File("rt"),
     required=True,
-    help="Input: List of labels (i.e. sequence identifiers) used in embeddings or foldseek search",
+    help="Input: Label index, i.e. ordered list of labels (sequence identifiers) used in embeddings or foldseek search (see create-label-index)",
+)
+@click.option(
+    "--neighbours",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Parameter: Only write each label's k nearest embeddings as a sparse SSV neighbour file, all other pairs being at the default distance of 100",
+)
+@click.option(
+    "--previous_matrix",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    default=None,
+    help="Input: Binary matrix of a previous run (with its <matrix>.labels and <matrix>.meta.json), written with the same metric and dtype. Only distances involving new labels or changed embeddings are computed, removed labels are dropped",
+)
+@click.option(
+    "--reduce_dim",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Parameter: Project embeddings to this number of dimensions before computing distances (default: no reduction)",
+)
+@click.option(
+    "--reduction",
+    type=click.Choice(REDUCTIONS),
+    default="pca",
+    help="Parameter: Dimensionality reduction, PCA or seeded Gaussian random projection (default: pca)",
+)
+@click.option(
+    "--reduction_seed",
+    type=int,
+    default=2023,
+    help="Parameter: Seed of the random projection and of the pairs sampled to report distortion (default: 2023)",
+)
+@click.option(
+    "--reduction_fit_input",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    multiple=True,
+    help="Input: PT files of embeddings to fit the PCA on, i.e. all projects of a superfamily (default: this project)",
+)
+@click.option(
+    "--distortion_pairs",
+    type=click.IntRange(min=1),
+    default=10000,
+    help="Parameter: Number of sampled pairs used to report the distance distortion of the reduction (default: 10000)",
+)
+@click.option(
+    "--tile_size",
+    type=int,
+    default=DEFAULT_TILE_SIZE,
+    help=f"Parameter: Number of rows/columns computed per tile of the matrix (default: {DEFAULT_TILE_SIZE})",
+)
+@click.option(
+    "--threads",
+    type=int,
+    default=None,
+    help="Parameter: Number of CPU threads used for the embeddings matrix (default: all available)",
 )
 def create_distance_matrix(
     distance_source,
@@ -48,78 +146,263 @@ def create_distance_matrix(
     embedding_distance,
     matrix_output_file,
     labels_file,
+    matrix_format,
+    matrix_dtype,
+    matrix_compression,
+    writer_processes,
+    neighbours,
+    previous_matrix,
+    reduce_dim,
+    reduction,
+    reduction_seed,
+    reduction_fit_input,
+    distortion_pairs,
+    tile_size,
+    threads,
 ):
     """
     Create distance matrix based on embedding distances or Foldseek 1/bitscore distances
     """
     LOG.info(f"Processing: {input_to_process} source: {distance_source}")
-    nodes_labels = create_list_of_labels(labels_file)
-    labels_list = list(nodes_labels)
+    n_matrices = len(embedding_distance) if distance_source == "embeddings" else 1
+    if len(matrix_output_file) != n_matrices:
+        raise click.BadParameter(
+            f"Expected {n_matrices} output file(s), one per distance metric",
+            param_hint="--matrix_output_file",
+        )
+    if n_matrices > 1 and (neighbours is not None or previous_matrix is not None):
+        raise click.BadParameter(
+            "Nearest neighbours and incremental updates use a single distance metric",
+            param_hint="--embedding_distance",
+        )
+    if reduce_dim is not None and (
+        distance_source != "embeddings" or previous_matrix is not None
+    ):
+        raise click.BadParameter(
+            "Dimensionality reduction applies to embeddings, without incremental updates",
+            param_hint="--reduce_dim",
+        )
+    if neighbours is not None:
+        if distance_source != "embeddings":
+            raise click.BadParameter(
+                "Nearest neighbours require embeddings as distance source",
+                param_hint="--neighbours",
+            )
+        if matrix_format != "ssv":
+            raise click.BadParameter(
+                "Nearest neighbours are written as a sparse SSV file",
+                param_hint="--matrix_format",
+            )
+    if previous_matrix is not None and (
+        distance_source != "embeddings" or neighbours is not None
+    ):
+        raise click.BadParameter(
+            "Incremental updates require embeddings as distance source and a full matrix",
+            param_hint="--previous_matrix",
+        )
+    label_index = LabelIndex.read(labels_file)
+    labels_list = label_index.labels
 
     # Foldseek distances based on (1/bitscore)
     if distance_source == "foldseek":
-        fh_type = "rt"
-        foldseek_output_fh = open(input_to_process, fh_type)
-        foldseek_results = {}
-        for line in foldseek_output_fh:
-            results = line.split()
-            query, target, bitscore = results[0], results[1], results[-1]
-            foldseek_results[f"{query}{target}"] = bitscore
-        for i in range(len(labels_list)):
-            for j in range(i, len(labels_list)):
-                label1 = labels_list[i]
-                label2 = labels_list[j]
-                pair = f"{label1}{label2}"
-                reverse_pair = f"{label2}{label1}"
-                if label1 == label2:
-                    matrix_output_file.write(f">{label1} >{label2} 0.0\n")
-                    continue
-                elif pair in foldseek_results:
-                    LOG.info(pair)
-                    LOG.info(foldseek_results[pair])
-                    matrix_output_file.write(
-                        f">{label1} >{label2} {float(1/int(foldseek_results[pair]))}\n"
-                    )
-                elif reverse_pair in foldseek_results:
-                    LOG.info(reverse_pair)
-                    matrix_output_file.write(
-                        f">{label2} >{label1} {float(1/int(foldseek_results[reverse_pair]))}\n"
-                    )
-                else:
-                    matrix_output_file.write(f">{label1} >{label2} 100\n")
+        with open(input_to_process, "rt") as foldseek_output_fh:
+            foldseek_hits = FoldseekHits.from_m8(foldseek_output_fh, label_index)
+        matrix_writer = open_matrix_writer(
+            matrix_output_file[0],
+            labels_list,
+            matrix_format,
+            matrix_dtype,
+            writer_processes,
+            matrix_compression,
+            metadata={"metric": "foldseek"},
+        )
+        for start, band in foldseek_hits.iter_row_bands(tile_size):
+            matrix_writer.write_band(start, band)
+        matrix_writer.close()
 
     # Embeddings distances (euclidean or cosine)
     elif distance_source == "embeddings":
-        fh_type = "rb"
         if torch.cuda.is_available():
             device = torch.device("cuda")
         else:
             device = torch.device("cpu")
-        embedding_fh = open(input_to_process, fh_type)
-        embeddings = torch.load(embedding_fh, map_location=device)
-        embedding_dict = {}
-        for embedding in embeddings:
-            label = embedding["label"]
-            embedding_dict[label] = embedding["mean_representations"][33]
-        if embedding_distance == "cosine":
-            distance = cosine_distance
+        if threads:
+            torch.set_num_threads(threads)
+        matrix, positions = load_embedding_matrix(input_to_process, labels_list, device)
+        if reduce_dim is not None:
+            matrix = reduce_matrix(
+                matrix,
+                embedding_distance,
+                reduce_dim,
+                reduction,
+                reduction_seed,
+                reduction_fit_input,
+                distortion_pairs,
+                device,
+            )
+        engine = BlockedDistanceEngine(
+            matrix.to(device), metrics=embedding_distance, tile_size=tile_size
+        )
+        if neighbours is not None:
+            distances, neighbour_rows = engine.nearest_neighbours(neighbours)
+            label_of_row = np.flatnonzero(positions >= 0)
+            with open(matrix_output_file[0], "wt") as neighbours_fh:
+                write_sparse_ssv(
+                    neighbours_fh,
+                    labels_list,
+                    np.repeat(label_of_row, distances.shape[1]),
+                    label_of_row[neighbour_rows.ravel()],
+                    distances.ravel(),
+                )
         else:
-            distance = euclidean_distance
-        for i in range(len(labels_list)):
-            for j in range(i, len(labels_list)):
-                label1 = labels_list[i]
-                label2 = labels_list[j]
-                if label1 in embedding_dict and label2 in embedding_dict:
-                    matrix_output_file.write(
-                        f">{label1} >{label2} {distance(embedding_dict[label1],embedding_dict[label2])}\n"
-                    )
-                else:
-                    matrix_output_file.write(f">{label1} >{label2} 100\n")
+            hashes = embedding_hashes(matrix, positions)
+            if previous_matrix is not None:
+                previous_matrix = CondensedDistanceMatrix(previous_matrix)
+                previous_positions = map_previous_positions(
+                    labels_list,
+                    positions,
+                    previous_matrix,
+                    embedding_distance[0],
+                    matrix_dtype,
+                    hashes,
+                )
+                bands = engine.iter_updated_row_bands(
+                    positions, [previous_matrix], previous_positions
+                )
+            else:
+                bands = engine.iter_row_bands(positions)
+            matrix_writers = [
+                open_matrix_writer(
+                    output_file,
+                    labels_list,
+                    matrix_format,
+                    matrix_dtype,
+                    writer_processes,
+                    matrix_compression,
+                    metadata={"metric": metric, "embedding_hashes": hashes},
+                )
+                for output_file, metric in zip(matrix_output_file, embedding_distance)
+            ]
+            for start, metric_bands in bands:
+                for matrix_writer, band in zip(matrix_writers, metric_bands):
+                    matrix_writer.write_band(start, band)
+            for matrix_writer in matrix_writers:
+                matrix_writer.close()
     else:
         LOG.error("Unknown source for matrix data")
     LOG.info("DONE")
 
 
+def load_embedding_dict(input_to_process, device):
+    """Read a .pt file of ESM embeddings into a dict of label -> mean embedding
+
+    Each embedding holds the representation of the single layer it was
+    computed for (see calculate-esm-to-embed --repr_layer).
+    """
+    with open(input_to_process, "rb") as embedding_fh:
+        embeddings = torch.load(embedding_fh, map_location=device)
+    embedding_dict = {}
+    for embedding in embeddings:
+        label = embedding["label"]
+        (embedding_dict[label],) = embedding["mean_representations"].values()
+    return embedding_dict
+
+
+def load_embedding_matrix(input_to_process, labels_list, device):
+    """Stack the embeddings of the labels from a .pt file or an embedding store
+
+    Returns the matrix and, for each label, its row in the matrix (-1 if missing).
+    """
+    if is_embedding_store(input_to_process):
+        return EmbeddingStore(input_to_process).stack(labels_list, device)
+    embedding_dict = load_embedding_dict(input_to_process, device)
+    return stack_embeddings(embedding_dict, labels_list)
+
+
+def reduce_matrix(
+    matrix,
+    metrics,
+    reduce_dim,
+    reduction,
+    reduction_seed,
+    reduction_fit_input,
+    distortion_pairs,
+    device,
+):
+    """Reduce the stacked embeddings and log the distance distortion on sampled pairs"""
+    if reduce_dim > matrix.shape[1]:
+        raise click.BadParameter(
+            f"Cannot reduce {matrix.shape[1]}-dimensional embeddings to {reduce_dim} dimensions",
+            param_hint="--reduce_dim",
+        )
+    fit_matrix = None
+    if reduction_fit_input:
+        fit_matrix = torch.cat(
+            [
+                EmbeddingStore(fit_input).rows(slice(None), device)
+                if is_embedding_store(fit_input)
+                else torch.stack(list(load_embedding_dict(fit_input, device).values()))
+                for fit_input in reduction_fit_input
+            ]
+        )
+    reduced = reduce_embeddings(
+        matrix, reduce_dim, reduction, seed=reduction_seed, fit_matrix=fit_matrix
+    )
+    report = distance_distortion(
+        matrix, reduced, metrics, n_pairs=distortion_pairs, seed=reduction_seed
+    )
+    for metric, distortion in report.items():
+        LOG.info(
+            f"{reduction} to {reduce_dim} dimensions, {metric} distortion on {distortion_pairs} pairs: "
+            f"median relative error {distortion['median_relative_error']:.4f}, "
+            f"95th percentile {distortion['p95_relative_error']:.4f}, "
+            f"Spearman {distortion['spearman']:.4f}"
+        )
+    return reduced
+
+
+def map_previous_positions(labels_list, positions, previous_matrix, metric, dtype, hashes):
+    """Position in the previous matrix of each label whose distances can be reused
+
+    The previous matrix must have been written with the same metric and dtype.
+    A label is reused if it had an embedding in the previous run (zero self
+    distance) and its embedding is unchanged (same hash); all other labels get
+    -1 and are recomputed.
+    """
+    metadata = previous_matrix.metadata
+    if metadata is None:
+        raise click.BadParameter(
+            f"{previous_matrix.matrix_path} has no {metadata_path_of(previous_matrix.matrix_path)}, so its metric, dtype and embeddings are unknown",
+            param_hint="--previous_matrix",
+        )
+    for key, value in (("metric", metric), ("dtype", dtype)):
+        if metadata.get(key) != value:
+            raise click.BadParameter(
+                f"{previous_matrix.matrix_path} was written with {key} {metadata.get(key)}, not {value}",
+                param_hint="--previous_matrix",
+            )
+    previous_hashes = metadata.get("embedding_hashes") or [None] * len(previous_matrix)
+    previous_ids = previous_matrix.label_index.ids
+    had_embedding = previous_matrix.diagonal() == 0
+    previous_positions = np.full(len(labels_list), -1, dtype=np.int64)
+    changed = 0
+    for i, label in enumerate(labels_list):
+        previous_id = previous_ids.get(label)
+        if previous_id is None or not had_embedding[previous_id] or positions[i] < 0:
+            continue
+        if hashes[i] is None or previous_hashes[previous_id] != hashes[i]:
+            changed += 1
+            continue
+        previous_positions[i] = previous_id
+    reused = int((previous_positions >= 0).sum())
+    LOG.info(
+        f"Reusing {reused} labels of {previous_matrix.matrix_path}: "
+        f"{int((positions >= 0).sum()) - reused} to compute ({changed} with a changed embedding), "
+        f"{len(previous_matrix) - reused} dropped, changed or without embedding"
+    )
+    return previous_positions
+
+
 def euclidean_distance(embedding1, embedding2):
     return np.linalg.norm(embedding1 - embedding2)
 
@@ -129,11 +412,3 @@ def cosine_distance(embedding1, embedding2):
     cosine_dist = 1 - cosine_sim
     return cosine_dist
 
-
-def create_list_of_labels(labels_fh):
-    labels_set = set()
-    for line in labels_fh:
-        label = line.rstrip()
-        labels_set.add(label)
-    return labels_set
-
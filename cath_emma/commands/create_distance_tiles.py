@@ -0,0 +1,154 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import click
+import logging
+import torch
+from ..distance_engine import BlockedDistanceEngine, DEFAULT_TILE_SIZE
+from ..label_index import LabelIndex
+from ..matrix_tiles import (
+    missing_tiles,
+    upper_triangle_tiles,
+    write_tile,
+    write_tile_layout,
+)
+from .create_distance_matrix import load_embedding_matrix
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
+)
+
+LOG = logging.getLogger(__name__)
+
+# Tile job of this process, set directly or by init_tile_worker in worker processes
+_TILE_JOB = {}
+
+
+@click.command()
+@click.option(
+    "--input_to_process",
+    type=str,
+    required=True,
+    help="Input: PT file or embedding store (.npy) from ESM embeddings",
+)
+@click.option(
+    "--embedding_distance",
+    type=click.Choice(["cosine", "euclidean"]),
+    help="Parameter: Embedding distance metric. (default: euclidean)",
+    default="euclidean",
+)
+@click.option(
+    "--labels_file",
+    type=click.File("rt"),
+    required=True,
+    help="Input: Label index, i.e. ordered list of labels used in embeddings (see create-label-index)",
+)
+@click.option(
+    "--tile_dir",
+    type=click.Path(file_okay=False, dir_okay=True),
+    required=True,
+    help="Output: Directory of upper-triangle tiles, merged with merge-distance-tiles",
+)
+@click.option(
+    "--tile_size",
+    type=int,
+    default=DEFAULT_TILE_SIZE,
+    help=f"Parameter: Number of rows/columns per tile (default: {DEFAULT_TILE_SIZE})",
+)
+@click.option(
+    "--task_index",
+    type=int,
+    default=1,
+    help="Parameter: 1-based index of this task, i.e. $SGE_TASK_ID (default: 1)",
+)
+@click.option(
+    "--num_tasks",
+    type=int,
+    default=1,
+    help="Parameter: Number of tasks sharing the tiles; task i computes every num_tasks-th tile (default: 1)",
+)
+@click.option(
+    "--processes",
+    type=int,
+    default=1,
+    help="Parameter: Number of local worker processes computing the tiles of this task (default: 1)",
+)
+def create_distance_tiles(
+    input_to_process,
+    embedding_distance,
+    labels_file,
+    tile_dir,
+    tile_size,
+    task_index,
+    num_tasks,
+    processes,
+):
+    """Compute a share of the upper-triangle tiles of an embeddings distance matrix"""
+    labels_list = LabelIndex.read(labels_file).labels
+    write_tile_layout(tile_dir, labels_list, tile_size, embedding_distance)
+    tiles = upper_triangle_tiles(len(labels_list), tile_size)[task_index - 1 :: num_tasks]
+    todo = missing_tiles(tile_dir, tiles)
+    LOG.info(
+        f"Task {task_index}/{num_tasks}: {len(todo)} of {len(tiles)} tiles left to compute -> {tile_dir}"
+    )
+    if not todo:
+        LOG.info("DONE")
+        return
+
+    matrix, positions = load_embedding_matrix(
+        input_to_process, labels_list, torch.device("cpu")
+    )
+    if processes > 1:
+        # workers start from a forkserver, as torch has run threads by now, and
+        # receive the embeddings through shared memory
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=init_tile_worker,
+            initargs=(
+                matrix.share_memory_(),
+                positions,
+                embedding_distance,
+                tile_size,
+                tile_dir,
+                max(1, (os.cpu_count() or 1) // processes),
+            ),
+        ) as executor:
+            for tile in executor.map(compute_tile, todo):
+                LOG.debug(f"Computed tile {tile}")
+    else:
+        init_tile_worker(matrix, positions, embedding_distance, tile_size, tile_dir)
+        for tile in todo:
+            compute_tile(tile)
+    LOG.info("DONE")
+
+
+def init_tile_worker(matrix, positions, metric, tile_size, tile_dir, threads=None):
+    if threads is not None:
+        torch.set_num_threads(threads)
+    _TILE_JOB["engine"] = BlockedDistanceEngine(matrix, metrics=[metric], tile_size=tile_size)
+    _TILE_JOB["positions"] = positions
+    _TILE_JOB["tile_dir"] = tile_dir
+
+
+def compute_tile(tile):
+    """Compute and save one (row_block, col_block) tile of the current job"""
+    row_block, col_block = tile
+    engine = _TILE_JOB["engine"]
+    positions = _TILE_JOB["positions"]
+    n_labels = len(positions)
+    row_start = row_block * engine.tile_size
+    col_start = col_block * engine.tile_size
+    write_tile(
+        _TILE_JOB["tile_dir"],
+        row_block,
+        col_block,
+        engine.tile(
+            positions,
+            row_start,
+            min(row_start + engine.tile_size, n_labels),
+            col_start,
+            min(col_start + engine.tile_size, n_labels),
+        )[0],
+    )
+    return tile
@@ -0,0 +1,29 @@
+import click
+import logging
+from ..label_index import LabelIndex
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
+)
+
+LOG = logging.getLogger(__name__)
+
+
+@click.command()
+@click.option(
+    "--cluster_reps_file",
+    type=click.File("rt"),
+    required=True,
+    help="Input: CSV file of cluster representatives from MMseqs2 in ID,FASTA format (example: ${PROJECT}_reps.csv)",
+)
+@click.option(
+    "--label_index_file",
+    type=click.File("wt"),
+    required=True,
+    help="Output: Ordered list of labels, the line number being the label id (example: ${PROJECT}_ids_list)",
+)
+def create_label_index(cluster_reps_file, label_index_file):
+    """Create the ordered label index shared by the pipeline stages of a project"""
+    label_index = LabelIndex.from_reps_csv(cluster_reps_file)
+    label_index.write(label_index_file)
+    LOG.info(f"DONE. Indexed {len(label_index)} labels -> {label_index_file.name}")
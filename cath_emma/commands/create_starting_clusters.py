@@ -1,5 +1,6 @@
 import click
 import logging
+from ..label_index import LabelIndex
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
@@ -33,14 +34,22 @@ LOG = logging.getLogger(__name__)
     required=True,
     help="Mapping between cluster ids and working ids."
 )
+@click.option(
+    '--label_index_file',
+    type=click.File('rt'),
+    default=None,
+    help="Input: Label index of the project (see create-label-index). Starting cluster working_N is the label with id N-1. (default: order of the cluster reps file)"
+)
 
-def create_starting_clusters_from_centroids(cluster_reps_file,starting_clusters_dir,fasta_suffix,cluster_mapping_file):
+def create_starting_clusters_from_centroids(cluster_reps_file,starting_clusters_dir,fasta_suffix,cluster_mapping_file,label_index_file):
     """Create starting clusters of cluster representatives from MMseqs2"""
+    label_index = LabelIndex.read(label_index_file) if label_index_file else None
     counter = 1
     for line in cluster_reps_file:
         line = line.rstrip()
         cluster_rep_id,sequence = line.split(',')
-        cluster_file = f'working_{counter}.{fasta_suffix}'
+        working_id = label_index.id_of(cluster_rep_id) + 1 if label_index else counter
+        cluster_file = f'working_{working_id}.{fasta_suffix}'
         with open(f'{starting_clusters_dir}/{cluster_file}','wt') as starting_cluster_fh:
             starting_cluster_fh.write(f'>{cluster_rep_id}\n{sequence}')
         cluster_mapping_file.write(f'{cluster_rep_id}\t{cluster_file}\n')
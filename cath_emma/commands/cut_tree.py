@@ -0,0 +1,110 @@
+import os
+import click
+import logging
+import numpy as np
+from ..label_index import LabelIndex
+from ..merge_trace import TRACE_FILE, MergeTrace
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
+)
+
+LOG = logging.getLogger(__name__)
+
+
+def read_cluster_members(label_index, mmseqs_cluster_mapping):
+    """Members of each cluster rep, indexed by label id (as in populate-cluster-centroids)"""
+    cluster_members = [[] for _ in range(len(label_index))]
+    for line in mmseqs_cluster_mapping:
+        cluster_rep, cluster_member = line.split("\t")
+        cluster_members[label_index.id_of(cluster_rep.rstrip())].append(
+            cluster_member.rstrip()
+        )
+    return cluster_members
+
+
+@click.command()
+@click.option(
+    "--tree_dir",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True),
+    required=True,
+    help="Input: GeMMA tree directory containing tree.trace (see build-tree)",
+)
+@click.option(
+    "--labels_file",
+    type=click.File("rt"),
+    required=True,
+    help="Input: Label index of the project. Starting cluster working_N is the label with id N-1. (see create-label-index)",
+)
+@click.option(
+    "--threshold",
+    type=float,
+    multiple=True,
+    help="Parameter: Distance at which to cut the tree, repeat for several cuts",
+)
+@click.option(
+    "--threshold_range",
+    type=float,
+    nargs=3,
+    default=None,
+    help="Parameter: Cut at START, START+STEP, ... up to STOP (inclusive), given as START STOP STEP",
+)
+@click.option(
+    "--mmseqs_cluster_mapping",
+    type=click.File("rt"),
+    default=None,
+    help="Input: Cluster membership file from MMseqs (example: {PROJECT}_cluster.tsv), to list all members instead of the cluster reps",
+)
+@click.option(
+    "--output_prefix",
+    type=str,
+    required=True,
+    help="Output: Prefix of the clustmemb files, one per threshold (i.e. <prefix>.<threshold>.clustmemb)",
+)
+def cut_tree(
+    tree_dir, labels_file, threshold, threshold_range, mmseqs_cluster_mapping, output_prefix
+):
+    """Cut an eMMA tree at distance thresholds into clustmemb files"""
+    thresholds = list(threshold)
+    if threshold_range:
+        start, stop, step = threshold_range
+        if step <= 0:
+            raise click.BadParameter(
+                f"The step must be positive, got {step:g}", param_hint="--threshold_range"
+            )
+        # half a step of tolerance so that STOP itself is included
+        thresholds.extend(np.arange(start, stop + step / 2, step).round(10).tolist())
+    if not thresholds:
+        raise click.UsageError("Give at least one --threshold or a --threshold_range")
+    # each threshold names its own file: drop repeats, refuse distinct thresholds with the same name
+    threshold_of_name = {}
+    for cut in thresholds:
+        name = f"{cut:.10g}"
+        if threshold_of_name.setdefault(name, cut) != cut:
+            raise click.UsageError(
+                f"Thresholds {threshold_of_name[name]!r} and {cut!r} would both write {output_prefix}.{name}.clustmemb"
+            )
+    thresholds = list(threshold_of_name.values())
+    label_index = LabelIndex.read(labels_file)
+    trace = MergeTrace.read_path(os.path.join(tree_dir, TRACE_FILE))
+    if trace.n_leaves != len(label_index):
+        raise ValueError(
+            f"{tree_dir}/{TRACE_FILE} has {trace.n_leaves} starting clusters, the label index {len(label_index)}"
+        )
+    cluster_members = None
+    if mmseqs_cluster_mapping:
+        cluster_members = read_cluster_members(label_index, mmseqs_cluster_mapping)
+    clusters = trace.cut(thresholds)
+    for name, clusters_of_leaves in zip(threshold_of_name, clusters.tolist()):
+        clustmemb_path = f"{output_prefix}.{name}.clustmemb"
+        with open(clustmemb_path, "wt") as clustmemb_fh:
+            for label_id, cluster in enumerate(clusters_of_leaves):
+                members = (
+                    cluster_members[label_id]
+                    if cluster_members
+                    else [label_index.label_of(label_id)]
+                )
+                for member in members:
+                    clustmemb_fh.write(f"{cluster}\t{member}\n")
+        LOG.info(f"Cut at {name}: {max(clusters_of_leaves, default=0)} clusters -> {clustmemb_path}")
+    LOG.info("DONE")
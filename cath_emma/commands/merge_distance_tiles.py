@@ -0,0 +1,79 @@
+import click
+import logging
+from ..matrix_io import MATRIX_COMPRESSIONS, MATRIX_DTYPES, open_matrix_writer
+from ..matrix_tiles import (
+    check_tiles_complete,
+    iter_merged_row_bands,
+    read_tile_labels,
+    read_tile_layout,
+)
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
+)
+
+LOG = logging.getLogger(__name__)
+
+
+@click.command()
+@click.option(
+    "--tile_dir",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True),
+    required=True,
+    help="Input: Directory of tiles written by create-distance-tiles",
+)
+@click.option(
+    "--matrix_output_file",
+    type=click.Path(file_okay=True, dir_okay=False),
+    required=True,
+    help="Output: Distance matrix file for eMMA input",
+)
+@click.option(
+    "--matrix_format",
+    type=click.Choice(["ssv", "binary"]),
+    default="ssv",
+    help="Parameter: Output format, legacy '>label1 >label2 dist' text or a memory-mapped condensed .npy array with a <matrix>.labels index (default: ssv)",
+)
+@click.option(
+    "--matrix_dtype",
+    type=click.Choice(list(MATRIX_DTYPES)),
+    default="float32",
+    help="Parameter: Float type of the binary matrix (default: float32)",
+)
+@click.option(
+    "--matrix_compression",
+    type=click.Choice(MATRIX_COMPRESSIONS),
+    default="none",
+    help="Parameter: Stream the SSV matrix through a gzip or zstd compressor (default: none)",
+)
+@click.option(
+    "--writer_processes",
+    type=int,
+    default=1,
+    help="Parameter: Number of worker processes formatting the SSV matrix (default: 1)",
+)
+def merge_distance_tiles(
+    tile_dir,
+    matrix_output_file,
+    matrix_format,
+    matrix_dtype,
+    matrix_compression,
+    writer_processes,
+):
+    """Assemble the tiles of create-distance-tiles into one distance matrix"""
+    check_tiles_complete(tile_dir)
+    labels_list = read_tile_labels(tile_dir).labels
+    matrix_writer = open_matrix_writer(
+        matrix_output_file,
+        labels_list,
+        matrix_format,
+        matrix_dtype,
+        writer_processes,
+        matrix_compression,
+        # tiles keep no embedding hashes, so incremental runs recompute all labels
+        metadata={"metric": read_tile_layout(tile_dir)["metric"]},
+    )
+    for start, band in iter_merged_row_bands(tile_dir):
+        matrix_writer.write_band(start, band)
+    matrix_writer.close()
+    LOG.info("DONE")
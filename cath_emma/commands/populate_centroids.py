@@ -4,6 +4,7 @@ from pathlib import Path
 import click
 import logging
 from Bio import SeqIO
+from ..label_index import LabelIndex
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
@@ -12,6 +13,13 @@ logging.basicConfig(
 LOG = logging.getLogger(__name__)
 
 
+def rep_label_id(label_index, cluster_rep, mapping_fh):
+    """Label id of a cluster rep of a mapping file, which must be in the label index"""
+    if cluster_rep not in label_index:
+        raise ValueError(f'Cluster rep {cluster_rep} of {mapping_fh.name} is not in the label index')
+    return label_index.id_of(cluster_rep)
+
+
 @click.command()
 @click.option(
     "--cluster_reps_file",
@@ -49,26 +57,33 @@ LOG = logging.getLogger(__name__)
     help="Cluster membership file from MMseqs (example: {PROJECT}_cluster.tsv)",
     required=True,
     )
+@click.option(
+    "--label_index_file",
+    type=click.File("rt"),
+    default=None,
+    help="Input: Label index of the project (see create-label-index). (default: built from --cluster_reps_file)",
+    )
 
-def populate_cluster_centroids(cluster_reps_file,all_fasta,centroids_tree_dir,filled_tree_dir,starting_clusters_mapping_file,mmseqs_cluster_mapping):
+def populate_cluster_centroids(cluster_reps_file,all_fasta,centroids_tree_dir,filled_tree_dir,starting_clusters_mapping_file,mmseqs_cluster_mapping,label_index_file):
     """Populate starting cluster centroids with all sequences in the cluster"""
-    # Declare dictionaries
-    dict_mmseqs = {}
-    dict_starting_clusters = {}
+    if label_index_file:
+        label_index = LabelIndex.read(label_index_file)
+    else:
+        label_index = LabelIndex.from_reps_csv(cluster_reps_file)
+    # Cluster members and starting cluster filenames, indexed by label id of the cluster rep
+    cluster_members = [[] for _ in range(len(label_index))]
+    starting_clusters = [None] * len(label_index)
     # Populate MMseqs cluster membership distances
     for line in mmseqs_cluster_mapping:
         cluster_rep,cluster_member = line.split('\t')
         cluster_rep = cluster_rep.rstrip()
         cluster_member = cluster_member.rstrip()
-        if cluster_rep not in dict_mmseqs:
-            dict_mmseqs[cluster_rep] = [cluster_member]
-        else:
-            dict_mmseqs[cluster_rep].append(cluster_member)
-    # Populate starting clusters mapping dictionary
+        cluster_members[rep_label_id(label_index, cluster_rep, mmseqs_cluster_mapping)].append(cluster_member)
+    # Populate starting clusters mapping
     for line in starting_clusters_mapping_file:
         line = line.rstrip()
         cluster_rep, starting_cluster_filename = line.split('\t')
-        dict_starting_clusters[cluster_rep] = starting_cluster_filename
+        starting_clusters[rep_label_id(label_index, cluster_rep, starting_clusters_mapping_file)] = starting_cluster_filename
 
     # Create BioPython SeqIO dictionary
     sequence_dict = SeqIO.to_dict(SeqIO.parse(all_fasta, "fasta"))
@@ -82,11 +97,16 @@ def populate_cluster_centroids(cluster_reps_file,all_fasta,centroids_tree_dir,fi
         shutil.copy(f'{centroids_tree_dir}/tree.newick',f'{filled_tree_dir}/')
 
         
-    for cluster_id in dict_mmseqs:
-        filled_cluster_name = dict_starting_clusters[cluster_id]
+    for cluster_id, members in enumerate(cluster_members):
+        if not members:
+            continue
+        filled_cluster_name = starting_clusters[cluster_id]
+        if filled_cluster_name is None:
+            LOG.warning(f'Skipping cluster rep {label_index.label_of(cluster_id)}: not in {starting_clusters_mapping_file.name}')
+            continue
         seq_to_write = []
         output_file = f'{filled_tree_dir}/starting_cluster_alignments/{filled_cluster_name}'
-        for seq_id in dict_mmseqs[cluster_id]:
+        for seq_id in members:
             seq_to_write.append(sequence_dict[seq_id])
         SeqIO.write(seq_to_write, output_file, "fasta")
         counter +=1
@@ -94,13 +114,12 @@ def populate_cluster_centroids(cluster_reps_file,all_fasta,centroids_tree_dir,fi
     
     # Create filled merge node alignments
     counter_merge = 0
-    for file in Path(f'{centroids_tree_dir}/merge_node_alignments/').iterdir():
+    for file in sorted(Path(f'{centroids_tree_dir}/merge_node_alignments/').iterdir()):
         centroid_alignment = SeqIO.index(str(file), "fasta")
-        centroid_keys = set(centroid_alignment.keys())
-        shared_ids = centroid_keys & set(dict_mmseqs.keys())
+        shared_ids = sorted(label_index.id_of(key) for key in centroid_alignment.keys() if key in label_index)
         with open(f'{filled_tree_dir}/merge_node_alignments/{file.name}','wt') as filled_merge_node_fh:
             for id in shared_ids:
-                for cluster_member in dict_mmseqs[id]:
+                for cluster_member in cluster_members[id]:
                     filled_merge_node_fh.write(f'>{sequence_dict[cluster_member].description}\n{sequence_dict[cluster_member].seq}\n')
         counter_merge +=1
     LOG.info(f'Filled {counter_merge} merge_node alignments for FunFHMMER')
@@ -0,0 +1,123 @@
+import click
+import logging
+from ..distance_engine import DEFAULT_TILE_SIZE
+
+SGE_TMEM = "16G"
+SGE_H_RT = "8:0:0"
+SGE_JOB_NAME = "emma-tiles"
+SGE_MERGE_TMEM = "8G"
+SGE_MERGE_H_RT = "8:0:0"
+SGE_MERGE_JOB_NAME = "emma-tiles-merge"
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
+)
+
+LOG = logging.getLogger(__name__)
+
+
+@click.command()
+@click.option(
+    "--project",
+    type=str,
+    required=True,
+    help="Input: Project (MDA) id whose distance matrix is split in tiles",
+)
+@click.option(
+    "--sfam_path",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True, resolve_path=True),
+    required=True,
+    help="Input: Path to folder containing individual project folders i.e.<sfam-path>/{mda1,mda2}",
+    )
+@click.option(
+    "--venv_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, resolve_path=True),
+    required=True,
+    help="Path to venv with installed dependencies for CATH-eMMA CLI"
+    )
+@click.option(
+    "--num_tasks",
+    type=int,
+    required=True,
+    help="Parameter: Number of SGE array tasks sharing the tiles",
+)
+@click.option(
+    "--embedding_distance",
+    type=click.Choice(["cosine", "euclidean"]),
+    default="euclidean",
+    help="Parameter: Embedding distance metric. (default: euclidean)",
+)
+@click.option(
+    "--tile_size",
+    type=int,
+    default=DEFAULT_TILE_SIZE,
+    help=f"Parameter: Number of rows/columns per tile (default: {DEFAULT_TILE_SIZE})",
+)
+@click.option(
+    "--matrix_format",
+    type=click.Choice(["ssv", "binary"]),
+    default="ssv",
+    help="Parameter: Format of the merged matrix (default: ssv)",
+)
+@click.option(
+    "--output_script",
+    type=click.File("wt"),
+    required=True,
+    help="Output: File containing batch array script computing the tiles."
+    )
+@click.option(
+    "--merge_output_script",
+    type=click.File("wt"),
+    required=True,
+    help="Output: File containing the script merging the tiles, held until the array job finishes."
+    )
+def qsub_distance_tiles(project,sfam_path,venv_path,num_tasks,embedding_distance,tile_size,matrix_format,output_script,merge_output_script):
+    """Create qsub scripts computing one project's distance matrix as tiles over array tasks"""
+    matrix_suffix = "_embedding_matrix.npy" if matrix_format == "binary" else "_embedding_matrix.ssv"
+    # per-project job names, so the merge only waits for its own project's tiles
+    job_name = f"{SGE_JOB_NAME}-{project}"
+    output_script.write(
+        f"""\
+#$ -l tmem={SGE_TMEM}
+#$ -l h_vmem={SGE_TMEM}
+#$ -l h_rt={SGE_H_RT}
+#$ -S /bin/bash
+#$ -j y
+#$ -N {job_name}
+#$ -cwd
+#$ -P cath
+#$ -t 1-{num_tasks}
+PROJECT={project}
+export DATADIR='{sfam_path}'
+module load python/3.8.5
+source {venv_path}
+
+echo `date` ${{PROJECT}} tiles ${{SGE_TASK_ID}} START
+
+cath-emma-cli create-distance-tiles --input_to_process ${{DATADIR}}/${{PROJECT}}/${{PROJECT}}_embedded.pt --embedding_distance {embedding_distance} --labels_file ${{DATADIR}}/${{PROJECT}}/${{PROJECT}}_ids_list --tile_dir ${{DATADIR}}/${{PROJECT}}/distance_tiles --tile_size {tile_size} --task_index ${{SGE_TASK_ID}} --num_tasks {num_tasks}
+
+echo `date` ${{PROJECT}} tiles ${{SGE_TASK_ID}} END
+            """)
+    merge_output_script.write(
+        f"""\
+#$ -l tmem={SGE_MERGE_TMEM}
+#$ -l h_vmem={SGE_MERGE_TMEM}
+#$ -l h_rt={SGE_MERGE_H_RT}
+#$ -S /bin/bash
+#$ -j y
+#$ -N {SGE_MERGE_JOB_NAME}-{project}
+#$ -hold_jid {job_name}
+#$ -cwd
+#$ -P cath
+PROJECT={project}
+export DATADIR='{sfam_path}'
+module load python/3.8.5
+source {venv_path}
+
+echo `date` ${{PROJECT}} merge START
+
+cath-emma-cli merge-distance-tiles --tile_dir ${{DATADIR}}/${{PROJECT}}/distance_tiles --matrix_output_file ${{DATADIR}}/${{PROJECT}}/${{PROJECT}}{matrix_suffix} --matrix_format {matrix_format}
+
+echo `date` ${{PROJECT}} merge END
+            """)
+    LOG.info(f"Generated qsub scripts for {num_tasks} tile tasks of {project} -> {output_script.name}, {merge_output_script.name}")
@@ -64,7 +64,7 @@ source {venv_path}
 
 echo `date` ${{PROJECT}} START
 
-awk -F ',' '{{print $1}}' ${{DATADIR}}/${{PROJECT}}/${{PROJECT}}_reps.csv > ${{DATADIR}}/${{PROJECT}}/${{PROJECT}}_ids_list 
+cath-emma-cli create-label-index --cluster_reps_file ${{DATADIR}}/${{PROJECT}}/${{PROJECT}}_reps.csv --label_index_file ${{DATADIR}}/${{PROJECT}}/${{PROJECT}}_ids_list
 
 cath-emma-cli create-distance-matrix --distance_source embeddings --input_to_process ${{DATADIR}}/${{PROJECT}}/${{PROJECT}}_embedded.pt --embedding_distance euclidean --matrix_output_file ${{DATADIR}}/${{PROJECT}}/${{PROJECT}}_embedding_matrix.ssv --labels_file ${{DATADIR}}/${{PROJECT}}/${{PROJECT}}_ids_list
 
@@ -72,6 +72,6 @@ mkdir -p ${{DATADIR}}/${{PROJECT}}/starting_clusters
 mkdir -p ${{DATADIR}}/${{PROJECT}}/starting_clusters/${{PROJECT}}
 echo ${{PROJECT}} > ${{DATADIR}}/${{PROJECT}}/projects.txt
 
-cath-emma-cli create-starting-clusters-from-centroids --cluster_reps_file ${{DATADIR}}/${{PROJECT}}/${{PROJECT}}_reps.csv --starting_clusters_dir ${{DATADIR}}/${{PROJECT}}/starting_clusters/${{PROJECT}} --cluster_mapping_file ${{DATADIR}}/${{PROJECT}}/${{PROJECT}}_cluster_mapping.tsv
+cath-emma-cli create-starting-clusters-from-centroids --cluster_reps_file ${{DATADIR}}/${{PROJECT}}/${{PROJECT}}_reps.csv --starting_clusters_dir ${{DATADIR}}/${{PROJECT}}/starting_clusters/${{PROJECT}} --cluster_mapping_file ${{DATADIR}}/${{PROJECT}}/${{PROJECT}}_cluster_mapping.tsv --label_index_file ${{DATADIR}}/${{PROJECT}}/${{PROJECT}}_ids_list
             """)
     LOG.info(f"Generated qsub script for embeddings generation -> {output_script.name}")
\ No newline at end of file
@@ -66,6 +66,7 @@ cath-emma-cli populate-cluster-centroids \\
     --filled_tree_dir ${{DATADIR}}/${{PROJECT}}/filled_tree_first_iter \\
     --starting_clusters_mapping_file ${{DATADIR}}/${{PROJECT}}/${{PROJECT}}_cluster_mapping.tsv \\
     --mmseqs_cluster_mapping ${{DATADIR}}/${{PROJECT}}/${{PROJECT}}_cluster.tsv \\
+    --label_index_file ${{DATADIR}}/${{PROJECT}}/${{PROJECT}}_ids_list \\
 
 echo $(date) ${{PROJECT}} END
             """)
@@ -73,6 +73,24 @@ LOG = logging.getLogger(__name__)
     default="esm2",
     help="Input: String containing the type of ESM model to use. (default: esm2)",
 )
+@click.option(
+    "--projects_per_task",
+    type=int,
+    default=1,
+    help="Parameter: Number of projects embedded by each array task with the model loaded once (default: 1)",
+)
+@click.option(
+    "--h_rt",
+    type=str,
+    default=None,
+    help=f"Parameter: SGE run time limit of each task as H:M:S (default: {SGE_H_RT} per project of the task)",
+)
+@click.option(
+    "--h_vmem",
+    type=str,
+    default=SGE_TMEM,
+    help=f"Parameter: SGE memory limit (tmem and h_vmem) of each task; projects of a task are embedded one after the other, so the largest project sets it (default: {SGE_TMEM})",
+)
 def qsub_to_embeddings(
     qsub_output_file,
     array_job,
@@ -84,13 +102,18 @@ def qsub_to_embeddings(
     input_sequence_csv_path,
     embeddings_output_path,
     esm_model,
+    projects_per_task,
+    h_rt,
+    h_vmem,
 ):
     """Generate a qsub job for calculating ESM2 embeddings using calculate_esm_embeddings module"""
+    if h_rt is None:
+        h_rt = scale_h_rt(SGE_H_RT, projects_per_task if array_job == "True" else 1)
     qsub_output_file.write(
         f"""\
-#$ -l tmem={SGE_TMEM}
-#$ -l h_vmem={SGE_TMEM}
-#$ -l h_rt={SGE_H_RT}
+#$ -l tmem={h_vmem}
+#$ -l h_vmem={h_vmem}
+#$ -l h_rt={h_rt}
 #$ -S /bin/bash
 #$ -e /dev/null
 #$ -o /dev/null
@@ -101,7 +124,22 @@ def qsub_to_embeddings(
 #$ -P cath
 """
     )
-    if array_job == "True":
+    if array_job == "True" and projects_per_task > 1:
+        line_count = count_lines(project_list_file)
+        task_count = -(-line_count // projects_per_task)
+        qsub_output_file.write(
+            f"""\
+#$ -t 1-{task_count}
+DATADIR={project_path}
+FIRST_PROJECT=$(( (SGE_TASK_ID - 1) * {projects_per_task} + 1 ))
+LAST_PROJECT=$(( SGE_TASK_ID * {projects_per_task} ))
+INPUT_LIST=${{TMPDIR:-/tmp}}/{SGE_JOB_NAME}_${{JOB_ID}}_${{SGE_TASK_ID}}.list
+sed -n "${{FIRST_PROJECT}},${{LAST_PROJECT}}p" {os.path.abspath(project_list_file.name)} | while read PROJECT_ID; do
+    echo "${{DATADIR}}/${{PROJECT_ID}}/${{PROJECT_ID}}{sequence_suffix} ${{DATADIR}}/${{PROJECT_ID}}/${{PROJECT_ID}}{embeddings_suffix}"
+done > ${{INPUT_LIST}}
+"""
+        )
+    elif array_job == "True":
         line_count = count_lines(project_list_file)
         qsub_output_file.write(
             f"""\
@@ -117,6 +155,16 @@ module load python/3.8.5
 source {venv_location}\
 """
     )
+    if array_job == "True" and projects_per_task > 1:
+        qsub_output_file.write(
+            f"""
+cath-emma-cli calculate-esm-to-embed --input_list ${{INPUT_LIST}} --esm_model {esm_model}
+"""
+        )
+        LOG.info(
+            f"Generated qsub script for embeddings generation, {projects_per_task} projects per task -> {qsub_output_file.name}"
+        )
+        return
     project = ""
     input_sequence = input_sequence_csv_path
     embeddings_output = embeddings_output_path
@@ -132,6 +180,12 @@ cath-emma-cli calculate-esm-to-embed --input_sequence_csv {project_path}/{projec
     )
     LOG.info(f"Generated qsub script for embeddings generation -> {qsub_output_file.name}")
 
+def scale_h_rt(h_rt, factor):
+    """Multiply an H:M:S run time by factor"""
+    hours, minutes, seconds = (int(part) for part in h_rt.split(":"))
+    total = (hours * 3600 + minutes * 60 + seconds) * factor
+    return f"{total // 3600}:{total % 3600 // 60}:{total % 60}"
+
 def count_lines(filehandle):
     sum = 0
     for line in filehandle:
@@ -0,0 +1,95 @@
+import logging
+import numpy as np
+import torch
+
+LOG = logging.getLogger(__name__)
+
+REDUCTIONS = ["pca", "random"]
+
+
+def fit_pca(matrix, dim):
+    """Top `dim` principal axes (d x dim) of the rows of matrix
+
+    Uses the eigendecomposition of the d x d covariance matrix, so fitting is
+    O(n*d^2) and does not need an SVD of the n x d matrix.
+    """
+    matrix = matrix.to(torch.float64)
+    centered = matrix - matrix.mean(dim=0, keepdim=True)
+    covariance = centered.T @ centered / max(1, len(matrix) - 1)
+    eigenvalues, eigenvectors = torch.linalg.eigh(covariance)
+    order = torch.argsort(eigenvalues, descending=True)[:dim]
+    explained = eigenvalues[order].sum() / eigenvalues.sum().clamp_min(1e-12)
+    LOG.info(
+        f"PCA fitted on {len(matrix)} embeddings: {dim} components explain {float(explained):.1%} of the variance"
+    )
+    return eigenvectors[:, order]
+
+
+def random_projection(input_dim, dim, seed):
+    """Seeded Gaussian random projection (d x dim) preserving distances in expectation"""
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(input_dim, dim, generator=generator, dtype=torch.float64) / np.sqrt(
+        dim
+    )
+
+
+def reduce_embeddings(matrix, dim, reduction="pca", seed=2023, fit_matrix=None):
+    """Project the embedding rows to `dim` dimensions
+
+    PCA axes are fitted on `fit_matrix` (i.e. all embeddings of a superfamily)
+    or on the matrix itself. Rows are projected without centering, so euclidean
+    distances do not depend on the origin. How far euclidean and cosine
+    distances drift from the original ones is only known from the sampled
+    pairs of distance_distortion.
+    """
+    if dim > matrix.shape[1]:
+        raise ValueError(
+            f"Cannot reduce {matrix.shape[1]}-dimensional embeddings to {dim} dimensions"
+        )
+    if reduction == "pca":
+        projection = fit_pca(matrix if fit_matrix is None else fit_matrix, dim)
+    else:
+        projection = random_projection(matrix.shape[1], dim, seed)
+    projection = projection.to(matrix.device)
+    return matrix.to(torch.float64) @ projection
+
+
+def distance_distortion(original, reduced, metrics, n_pairs=10000, seed=2023):
+    """Compare distances of randomly sampled pairs before and after reduction
+
+    Returns, per metric, the median and 95th percentile relative error and the
+    Spearman rank correlation of the sampled distances.
+    """
+    n = len(original)
+    if n < 2:
+        return {}
+    rng = np.random.default_rng(seed)
+    first = rng.integers(0, n, n_pairs)
+    second = (first + rng.integers(1, n, n_pairs)) % n
+    report = {}
+    for metric in metrics:
+        before = pair_distances(original, first, second, metric)
+        after = pair_distances(reduced, first, second, metric)
+        relative_error = np.abs(after - before) / np.maximum(np.abs(before), 1e-12)
+        report[metric] = {
+            "median_relative_error": float(np.median(relative_error)),
+            "p95_relative_error": float(np.percentile(relative_error, 95)),
+            "spearman": spearman(before, after),
+        }
+    return report
+
+
+def pair_distances(matrix, first, second, metric):
+    a = matrix[torch.as_tensor(first, device=matrix.device)].to(torch.float64)
+    b = matrix[torch.as_tensor(second, device=matrix.device)].to(torch.float64)
+    if metric == "cosine":
+        distances = 1 - torch.nn.functional.cosine_similarity(a, b, dim=1)
+    else:
+        distances = torch.linalg.norm(a - b, dim=1)
+    return distances.cpu().numpy()
+
+
+def spearman(x, y):
+    x_ranks = np.argsort(np.argsort(x))
+    y_ranks = np.argsort(np.argsort(y))
+    return float(np.corrcoef(x_ranks, y_ranks)[0, 1])
@@ -0,0 +1,248 @@
+import hashlib
+import logging
+import numpy as np
+import torch
+
+LOG = logging.getLogger(__name__)
+
+# Distance written for pairs without a computed value (missing embedding or hit)
+DEFAULT_DISTANCE = 100
+DEFAULT_TILE_SIZE = 2048
+
+
+class BlockedDistanceEngine:
+    """Compute pairwise embedding distances tile by tile with matrix operations
+
+    The embeddings are stacked into one float64 matrix and each tile is a single
+    Gram matrix multiplication shared by all requested metrics: euclidean
+    distances use the Gram trick (|a|^2 + |b|^2 - 2ab) and cosine distances the
+    dot products divided by the row norms. Tiles and bands are returned as lists
+    with one array per metric, in the order of `metrics`.
+    """
+
+    def __init__(self, matrix, metrics=("euclidean",), tile_size=DEFAULT_TILE_SIZE):
+        if isinstance(metrics, str):
+            metrics = (metrics,)
+        self.metrics = tuple(metrics)
+        self.tile_size = tile_size
+        matrix = matrix.to(torch.float64)
+        self.sq_norms = (matrix * matrix).sum(dim=1)
+        self.norms = self.sq_norms.sqrt().clamp_min(1e-8)
+        self.matrix = matrix
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def _distances(self, rows, cols):
+        gram = self.matrix[rows] @ self.matrix[cols].T
+        distances = []
+        for metric in self.metrics:
+            if metric == "cosine":
+                distances.append(
+                    1 - gram / (self.norms[rows][:, None] * self.norms[cols][None, :])
+                )
+            else:
+                squared = (
+                    self.sq_norms[rows][:, None] + self.sq_norms[cols][None, :] - 2 * gram
+                )
+                distances.append(squared.clamp_min_(0).sqrt_())
+        return distances
+
+    def block(self, rows, cols):
+        """Distances between two sets of rows of the stacked matrix as float32 arrays"""
+        return [
+            distances.to(torch.float32).cpu().numpy()
+            for distances in self._distances(rows, cols)
+        ]
+
+    def nearest_neighbours(self, k):
+        """Exact k nearest neighbours of every row of the stacked matrix
+
+        Returns (distances, neighbours) arrays of shape (n, k) for the first
+        metric, computed with a running top-k over column tiles so memory stays
+        O(n*k + tile_size^2). With a single row there are no neighbours and
+        the arrays are (n, 0).
+        """
+        if k < 1:
+            raise ValueError(f"Number of neighbours must be at least 1, got {k}")
+        n = len(self)
+        k = max(min(k, n - 1), 0)
+        device = self.matrix.device
+        all_distances = np.empty((n, k), dtype=np.float32)
+        all_neighbours = np.empty((n, k), dtype=np.int64)
+        if k == 0:
+            return all_distances, all_neighbours
+        for start in range(0, n, self.tile_size):
+            stop = min(start + self.tile_size, n)
+            rows = torch.arange(start, stop, device=device)
+            best_distances = torch.empty(
+                (stop - start, 0), dtype=torch.float64, device=device
+            )
+            best_neighbours = torch.empty(
+                (stop - start, 0), dtype=torch.int64, device=device
+            )
+            for col_start in range(0, n, self.tile_size):
+                col_stop = min(col_start + self.tile_size, n)
+                cols = torch.arange(col_start, col_stop, device=device)
+                distances = self._distances(rows, cols)[0]
+                # a label is not its own neighbour
+                if col_start < stop and start < col_stop:
+                    self_rows = torch.arange(
+                        max(start, col_start), min(stop, col_stop), device=device
+                    )
+                    distances[self_rows - start, self_rows - col_start] = float("inf")
+                distances = torch.cat([best_distances, distances], dim=1)
+                neighbours = torch.cat(
+                    [best_neighbours, cols.expand(stop - start, -1)], dim=1
+                )
+                best_distances, best = torch.topk(
+                    distances, min(k, distances.shape[1]), dim=1, largest=False
+                )
+                best_neighbours = torch.gather(neighbours, 1, best)
+            all_distances[start:stop] = best_distances.to(torch.float32).cpu().numpy()
+            all_neighbours[start:stop] = best_neighbours.cpu().numpy()
+        return all_distances, all_neighbours
+
+    def _new_bands(self, n_rows, n_cols):
+        return [
+            np.full((n_rows, n_cols), DEFAULT_DISTANCE, dtype=np.float32)
+            for _ in self.metrics
+        ]
+
+    def _fill_bands(self, bands, start, positions, band_rows, cols):
+        """Compute the distances of band rows (offsets from start) to label columns"""
+        if not len(band_rows) or not len(cols):
+            return
+        rows = torch.as_tensor(positions[band_rows + start], device=self.matrix.device)
+        cols_positions = torch.as_tensor(positions[cols], device=self.matrix.device)
+        for band, block in zip(bands, self.block(rows, cols_positions)):
+            band[np.ix_(band_rows, cols)] = block
+
+    def tile(self, positions, row_start, row_stop, col_start, col_stop):
+        """Distances between two ranges of labels as float32 arrays, one per metric
+
+        Pairs involving a label without embedding get DEFAULT_DISTANCE and self
+        distances are exactly zero, as with the pairwise functions.
+        """
+        tiles = self._new_bands(row_stop - row_start, col_stop - col_start)
+        rows = np.flatnonzero(positions[row_start:row_stop] >= 0)
+        cols = np.flatnonzero(positions[col_start:col_stop] >= 0)
+        if len(rows) and len(cols):
+            blocks = self.block(
+                torch.as_tensor(positions[rows + row_start], device=self.matrix.device),
+                torch.as_tensor(positions[cols + col_start], device=self.matrix.device),
+            )
+            for tile, block in zip(tiles, blocks):
+                tile[np.ix_(rows, cols)] = block
+        diagonal = np.arange(max(row_start, col_start), min(row_stop, col_stop))
+        diagonal = diagonal[positions[diagonal] >= 0]
+        for tile in tiles:
+            tile[diagonal - row_start, diagonal - col_start] = 0.0
+        return tiles
+
+    def iter_row_bands(self, positions):
+        """Yield (start, bands) for the upper triangle of the matrix over all labels
+
+        `positions` holds, for each label in output order, its row in the stacked
+        matrix or -1 when the label has no embedding. Each band is a float32 array
+        of shape (band_rows, n_labels) where only the columns j >= start + row are
+        filled; pairs involving a missing label get DEFAULT_DISTANCE.
+        """
+        n_labels = len(positions)
+        for start in range(0, n_labels, self.tile_size):
+            stop = min(start + self.tile_size, n_labels)
+            bands = self._new_bands(stop - start, n_labels)
+            for col_start in range(start, n_labels, self.tile_size):
+                col_stop = min(col_start + self.tile_size, n_labels)
+                tiles = self.tile(positions, start, stop, col_start, col_stop)
+                for band, tile in zip(bands, tiles):
+                    band[:, col_start:col_stop] = tile
+            yield start, bands
+
+    def iter_updated_row_bands(self, positions, previous_matrices, previous_positions):
+        """Yield the same bands as iter_row_bands, reusing previous matrices
+
+        `previous_matrices` holds one previous matrix per metric and
+        `previous_positions`, for each label, its position in them or -1 for
+        labels that need computing. Only pairs involving at least one such label
+        are computed; the others are copied.
+        """
+        n_labels = len(positions)
+        present = positions >= 0
+        reused = previous_positions >= 0
+        computed = present & ~reused
+        for start in range(0, n_labels, self.tile_size):
+            stop = min(start + self.tile_size, n_labels)
+            bands = self._new_bands(stop - start, n_labels)
+            band_rows = np.flatnonzero(present[start:stop])
+            reused_rows = np.flatnonzero(reused[start:stop])
+            computed_rows = np.flatnonzero(computed[start:stop])
+            reused_cols = start + np.flatnonzero(reused[start:])
+            for band, previous_matrix in zip(bands, previous_matrices):
+                copy_previous_rows(
+                    band,
+                    previous_matrix,
+                    reused_rows,
+                    reused_cols,
+                    previous_positions[reused_rows + start],
+                    previous_positions[reused_cols],
+                )
+            for col_start in range(start, n_labels, self.tile_size):
+                col_stop = min(col_start + self.tile_size, n_labels)
+                cols = col_start + np.flatnonzero(present[col_start:col_stop])
+                computed_cols = col_start + np.flatnonzero(computed[col_start:col_stop])
+                self._fill_bands(bands, start, positions, computed_rows, cols)
+                self._fill_bands(bands, start, positions, reused_rows, computed_cols)
+            for band in bands:
+                band[band_rows, band_rows + start] = 0.0
+            yield start, bands
+
+
+def copy_previous_rows(band, previous_matrix, band_rows, cols, previous_rows, previous_cols):
+    """Copy previous distances of band rows to columns, reading one row() view per row
+
+    Columns after the row in the previous matrix are gathered from the row
+    view; the others (left of the diagonal, or labels reordered since the
+    previous matrix) are read with block().
+    """
+    for band_row, previous_row in zip(band_rows.tolist(), previous_rows.tolist()):
+        after = previous_cols >= previous_row
+        band[band_row, cols[after]] = previous_matrix.row(previous_row)[
+            previous_cols[after] - previous_row
+        ]
+        if not after.all():
+            band[band_row, cols[~after]] = previous_matrix.block(
+                [previous_row], previous_cols[~after]
+            )[0]
+
+
+def stack_embeddings(embedding_dict, labels_list):
+    """Stack the embeddings of the labels into one matrix
+
+    Returns the matrix and, for each label, its row in the matrix (-1 if missing).
+    """
+    positions = np.full(len(labels_list), -1, dtype=np.int64)
+    rows = []
+    for i, label in enumerate(labels_list):
+        if label in embedding_dict:
+            positions[i] = len(rows)
+            rows.append(embedding_dict[label])
+    if rows:
+        matrix = torch.stack(rows)
+    else:
+        matrix = torch.empty((0, 0))
+    LOG.info(f"Stacked {len(rows)} embeddings for {len(labels_list)} labels")
+    return matrix, positions
+
+
+def embedding_hashes(matrix, positions):
+    """md5 of each label's embedding as float32 bytes (None for labels without embedding)
+
+    Recorded with binary matrices, so an incremental run only reuses the
+    distances of labels whose embedding is unchanged.
+    """
+    rows = matrix.detach().to(torch.float32).cpu().numpy()
+    return [
+        hashlib.md5(rows[position].tobytes()).hexdigest() if position >= 0 else None
+        for position in positions.tolist()
+    ]
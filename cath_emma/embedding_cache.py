@@ -0,0 +1,137 @@
+import hashlib
+import logging
+import sqlite3
+import time
+import numpy as np
+import torch
+
+LOG = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    model TEXT NOT NULL,
+    layer INTEGER NOT NULL,
+    pooling TEXT NOT NULL,
+    sequence_md5 TEXT NOT NULL,
+    vector BLOB NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (model, layer, pooling, sequence_md5)
+)
+"""
+CREATE_LRU_INDEX = "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+
+# sqlite limits the number of host parameters of a statement
+QUERY_CHUNK = 500
+# eviction frees a tenth of max_bytes, so the cache is measured once per tenth written
+EVICTION_HEADROOM = 0.9
+
+
+def sequence_md5(sequence):
+    """Hex md5 of the upper-case sequence, as sequence_md5 in the CATH/Gene3D tables
+
+    Sequences are embedded upper-case too (see SequenceEmbedder.embed), as ESM
+    reads lower-case residues as unknown.
+    """
+    return hashlib.md5(sequence.upper().encode("ascii")).hexdigest()
+
+
+class EmbeddingCache:
+    """Persistent sqlite cache of pooled embeddings
+
+    Embeddings are content-addressed by (model, layer, pooling, sequence md5) and
+    stored as float32 blobs, so the same sequence is embedded once across
+    projects, runs and releases. Entries are stamped when read or written and,
+    with `max_bytes`, the least recently used ones are evicted once a running
+    total of the bytes written goes over it.
+    """
+
+    def __init__(self, path, model, layer, pooling, max_bytes=None):
+        self.path = path
+        self.model = model
+        self.layer = layer
+        self.pooling = pooling
+        self.max_bytes = max_bytes
+        # array tasks of the same superfamily may share the cache
+        self.connection = sqlite3.connect(path, timeout=600)
+        self.connection.execute(SCHEMA)
+        self.connection.execute(CREATE_LRU_INDEX)
+        self.connection.commit()
+        self.total_bytes = None if max_bytes is None else self.size_bytes()
+
+    def _key(self, md5):
+        return (self.model, self.layer, self.pooling, md5)
+
+    def get_many(self, md5s):
+        """Cached embeddings of the given sequence md5s as a dict md5 -> tensor"""
+        md5s = list(md5s)
+        found = {}
+        for start in range(0, len(md5s), QUERY_CHUNK):
+            chunk = md5s[start : start + QUERY_CHUNK]
+            rows = self.connection.execute(
+                "SELECT sequence_md5, vector FROM embeddings"
+                " WHERE model = ? AND layer = ? AND pooling = ?"
+                f" AND sequence_md5 IN ({','.join('?' * len(chunk))})",
+                (self.model, self.layer, self.pooling, *chunk),
+            )
+            for md5, vector in rows:
+                found[md5] = torch.from_numpy(np.frombuffer(vector, dtype=np.float32).copy())
+        now = time.time()
+        self.connection.executemany(
+            "UPDATE embeddings SET last_used = ?"
+            " WHERE model = ? AND layer = ? AND pooling = ? AND sequence_md5 = ?",
+            [(now, *self._key(md5)) for md5 in found],
+        )
+        self.connection.commit()
+        return found
+
+    def put_many(self, embeddings):
+        """Add a dict md5 -> tensor of embeddings, evicting once the cache may exceed max_bytes"""
+        now = time.time()
+        rows = [
+            (
+                *self._key(md5),
+                embedding.detach().to(torch.float32).cpu().numpy().tobytes(),
+                now,
+            )
+            for md5, embedding in embeddings.items()
+        ]
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO embeddings"
+            " (model, layer, pooling, sequence_md5, vector, last_used)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        self.connection.commit()
+        if self.max_bytes is not None:
+            # an estimate that evict corrects: replaced rows count twice, rows of other writers not at all
+            self.total_bytes += sum(len(row[4]) for row in rows)
+            if self.total_bytes > self.max_bytes:
+                self.evict(int(EVICTION_HEADROOM * self.max_bytes))
+
+    def size_bytes(self):
+        return self.connection.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()[0]
+
+    def evict(self, max_bytes):
+        """Delete the least recently used embeddings until the cache fits max_bytes"""
+        excess = self.size_bytes() - max_bytes
+        if excess <= 0:
+            self.total_bytes = max_bytes + excess
+            return 0
+        evicted = []
+        for rowid, size in self.connection.execute(
+            "SELECT rowid, LENGTH(vector) FROM embeddings ORDER BY last_used"
+        ):
+            if excess <= 0:
+                break
+            evicted.append((rowid,))
+            excess -= size
+        self.connection.executemany("DELETE FROM embeddings WHERE rowid = ?", evicted)
+        self.connection.commit()
+        self.total_bytes = max_bytes + excess
+        LOG.info(f"Evicted {len(evicted)} embeddings from {self.path}")
+        return len(evicted)
+
+    def close(self):
+        self.connection.close()
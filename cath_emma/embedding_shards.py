@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+import torch
+from .embedding_store import EmbeddingStoreWriter, pt_vector
+from .io_utils import save_atomic
+
+LOG = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+DEFAULT_SHARD_SIZE = 1000
+
+
+def shard_path(shard_dir, shard):
+    return os.path.join(shard_dir, f"shard_{shard:05d}.pt")
+
+
+def shard_ranges(n_sequences, shard_size):
+    """(start, stop) input rows of each shard"""
+    return [
+        (start, min(start + shard_size, n_sequences))
+        for start in range(0, n_sequences, shard_size)
+    ]
+
+
+def read_manifest(shard_dir):
+    with open(os.path.join(shard_dir, MANIFEST_FILE), "rt") as manifest_fh:
+        return json.load(manifest_fh)
+
+
+def write_manifest(shard_dir, manifest):
+    def save_manifest(path):
+        with open(path, "wt") as manifest_fh:
+            json.dump(manifest, manifest_fh)
+
+    save_atomic(os.path.join(shard_dir, MANIFEST_FILE), save_manifest)
+
+
+def open_manifest(shard_dir, layout):
+    """Manifest of the shards of this run, i.e. the completed labels of each shard
+
+    A new manifest is created for a new shard directory; an existing one must
+    have been written for the same input and parameters, so a rerun resumes
+    from the shards it holds.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    if os.path.exists(os.path.join(shard_dir, MANIFEST_FILE)):
+        manifest = read_manifest(shard_dir)
+        if manifest["layout"] != layout:
+            raise ValueError(
+                f"{shard_dir} holds embedding shards of another run ({manifest['layout']})"
+            )
+        return manifest
+    manifest = {"layout": layout, "shards": {}}
+    write_manifest(shard_dir, manifest)
+    return manifest
+
+
+def write_shard(shard_dir, manifest, shard, embeddings):
+    """Save the embeddings of one shard, then record its labels in the manifest"""
+
+    def save_shard(path):
+        with open(path, "wb") as shard_fh:
+            torch.save(embeddings, shard_fh)
+
+    save_atomic(shard_path(shard_dir, shard), save_shard)
+    manifest["shards"][str(shard)] = [embedding["label"] for embedding in embeddings]
+    write_manifest(shard_dir, manifest)
+
+
+def check_shards_complete(shard_dir):
+    manifest = read_manifest(shard_dir)
+    layout = manifest["layout"]
+    n_shards = len(shard_ranges(layout["n_sequences"], layout["shard_size"]))
+    missing = [
+        shard for shard in range(n_shards) if str(shard) not in manifest["shards"]
+    ]
+    if missing:
+        raise FileNotFoundError(
+            f"{len(missing)} of {n_shards} embedding shards missing in {shard_dir} (i.e. {shard_path(shard_dir, missing[0])})"
+        )
+    return manifest
+
+
+def iter_shards(shard_dir):
+    """Yield the embeddings of each shard, in input order"""
+    manifest = check_shards_complete(shard_dir)
+    for shard in range(len(manifest["shards"])):
+        yield torch.load(shard_path(shard_dir, shard), map_location="cpu")
+
+
+def consolidate_shards(
+    shard_dir, embeddings_output, embeddings_format="pt", dtype="float32"
+):
+    """Write all shards as one embeddings file
+
+    `pt` is the list of {"label", "mean_representations"} dicts written by
+    calculate-esm-to-embed; `npy` is an embedding store, streamed shard by shard.
+    """
+    if embeddings_format == "pt":
+        embeddings = [
+            embedding for shard in iter_shards(shard_dir) for embedding in shard
+        ]
+
+        def save_embeddings(path):
+            with open(path, "wb") as embeddings_fh:
+                torch.save(embeddings, embeddings_fh)
+
+        save_atomic(embeddings_output, save_embeddings)
+        return len(embeddings)
+
+    manifest = check_shards_complete(shard_dir)
+    writer = EmbeddingStoreWriter(
+        embeddings_output,
+        [
+            label
+            for shard in range(len(manifest["shards"]))
+            for label in manifest["shards"][str(shard)]
+        ],
+        dtype,
+    )
+    for shard in iter_shards(shard_dir):
+        for embedding in shard:
+            writer.write(pt_vector(embedding))
+    writer.close()
+    return writer.row
@@ -0,0 +1,137 @@
+import logging
+import os
+import numpy as np
+import torch
+from .label_index import LabelIndex
+from .matrix_io import MATRIX_DTYPES, labels_path_of
+
+LOG = logging.getLogger(__name__)
+
+EMBEDDING_FORMATS = ["pt", "npy"]
+
+
+def is_embedding_store(path):
+    return str(path).endswith(".npy")
+
+
+def embeddings_exist(path):
+    """Whether an embeddings output is complete; a store writes its labels last"""
+    if is_embedding_store(path):
+        return os.path.exists(path) and os.path.exists(labels_path_of(path))
+    return os.path.exists(path)
+
+
+class EmbeddingStoreWriter:
+    """Write embeddings row by row into an (n, dim) .npy array with a <store>.labels index
+
+    The array is created on the first row, once the embedding dimension is known.
+    Vectors are written in the order of labels_list; the vectors of repeated
+    labels are skipped, as the label index keeps their first occurrence.
+    """
+
+    def __init__(self, store_path, labels_list, dtype="float32"):
+        self.store_path = store_path
+        self.labels_list = list(labels_list)
+        self.label_index = LabelIndex(self.labels_list)
+        self.dtype = MATRIX_DTYPES[dtype]
+        self.matrix = None
+        self.row = 0
+        self.written = 0
+
+    def write(self, vector):
+        label = self.labels_list[self.written]
+        self.written += 1
+        if self.label_index.id_of(label) != self.row:
+            LOG.warning(f"Skipping the embedding of duplicate label {label}")
+            return
+        vector = np.asarray(vector, dtype=self.dtype)
+        if self.matrix is None:
+            self.matrix = np.lib.format.open_memmap(
+                self.store_path,
+                mode="w+",
+                dtype=self.dtype,
+                shape=(len(self.label_index), len(vector)),
+            )
+        self.matrix[self.row] = vector
+        self.row += 1
+
+    def close(self):
+        if self.row != len(self.label_index):
+            raise ValueError(
+                f"Wrote {self.row} embeddings for {len(self.label_index)} labels to {self.store_path}"
+            )
+        if self.matrix is None:
+            # the embedding dimension is unknown, and labels without a store would pass for complete
+            raise ValueError(f"No embeddings to write to {self.store_path}")
+        self.matrix.flush()
+        del self.matrix
+        self.label_index.write_path(labels_path_of(self.store_path))
+        LOG.info(f"Wrote embedding store -> {self.store_path}")
+
+
+def write_embedding_store(store_path, embeddings, dtype="float32"):
+    """Write a list of .pt style embeddings ({"label", "mean_representations"})"""
+    writer = EmbeddingStoreWriter(
+        store_path, [embedding["label"] for embedding in embeddings], dtype
+    )
+    for embedding in embeddings:
+        writer.write(pt_vector(embedding))
+    writer.close()
+
+
+def pt_vector(embedding):
+    """The pooled vector of one .pt embedding as a float32 numpy array"""
+    (vector,) = embedding["mean_representations"].values()
+    return vector.detach().to(torch.float32).cpu().numpy()
+
+
+class EmbeddingStore:
+    """Embeddings of a project as one (n, dim) float array plus an ordered label index
+
+    The .npy array is memory-mapped, so opening a store reads no embeddings and
+    rows are only read from disk when sliced.
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self.matrix = np.load(store_path, mmap_mode="r")
+        self.label_index = LabelIndex.read_path(labels_path_of(store_path))
+        if len(self.label_index) != len(self.matrix):
+            raise ValueError(
+                f"{store_path} holds {len(self.matrix)} embeddings for {len(self.label_index)} labels"
+            )
+
+    @property
+    def labels(self):
+        return self.label_index.labels
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def __contains__(self, label):
+        return label in self.label_index
+
+    def rows(self, ids, device=None):
+        """Embeddings of the given row ids (or slice) as a float32 tensor"""
+        rows = torch.from_numpy(np.array(self.matrix[ids], dtype=np.float32))
+        return rows if device is None else rows.to(device)
+
+    def stack(self, labels_list, device=None):
+        """Same as distance_engine.stack_embeddings, reading only the needed rows
+
+        Returns the matrix and, for each label, its row in the matrix (-1 if missing).
+        """
+        positions = np.full(len(labels_list), -1, dtype=np.int64)
+        ids = []
+        for i, label in enumerate(labels_list):
+            if label in self.label_index:
+                positions[i] = len(ids)
+                ids.append(self.label_index.id_of(label))
+        if ids:
+            matrix = self.rows(ids, device)
+        else:
+            matrix = torch.empty((0, 0))
+        LOG.info(
+            f"Stacked {len(ids)} embeddings from {self.store_path} for {len(labels_list)} labels"
+        )
+        return matrix, positions
@@ -0,0 +1,542 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import esm
+import numpy as np
+import torch
+from tqdm import tqdm
+from .dim_reduction import distance_distortion
+from .embedding_cache import sequence_md5
+
+LOG = logging.getLogger(__name__)
+
+# --esm_model choice -> esm.pretrained loader
+ESM_MODELS = {
+    "esm1v": "esm1v_t33_650M_UR90S_1",  # can run on 12GB GPU
+    "esm1b": "esm1b_t33_650M_UR50S",  # can run on 12GB GPU
+    "esm2": "esm2_t33_650M_UR50D",  # can run on 12GB GPU
+    "esm2_3b": "esm2_t36_3B_UR50D",  # can run on 24GB GPU
+    "esm2_15b": "esm2_t48_15B_UR50D",  # not possible to run on the cluster, too large
+}
+
+DEFAULT_REPR_LAYER = 33
+POOLINGS = ["residue_mean", "token_mean"]
+PRECISIONS = ["fp32", "bf16", "int8"]
+
+# Set before forking the embedding workers so they share the model copy-on-write
+_EMBEDDING_JOB = {}
+
+
+def load_esm_model(esm_model):
+    return getattr(esm.pretrained, ESM_MODELS[esm_model])()
+
+
+def truncate_model(model, repr_layer):
+    """Drop the layers after repr_layer and the language model head
+
+    The representation of the last layer is layer-normed by the model, so when
+    layers are dropped the final layer norm is replaced by an identity to return
+    the same representation of repr_layer as the full model. The logits of the
+    truncated model are meaningless.
+    """
+    num_layers = len(model.layers)
+    if not 1 <= repr_layer <= num_layers:
+        raise ValueError(f"Layer {repr_layer} not in 1..{num_layers}")
+    if repr_layer < num_layers:
+        model.layers = model.layers[:repr_layer]
+        model.emb_layer_norm_after = torch.nn.Identity()
+        LOG.info(f"Truncated the model to {repr_layer} of {num_layers} layers")
+    model.lm_head = torch.nn.Identity()
+    return model
+
+
+def quantize_model(model):
+    """Dynamic int8 quantization of the linear layers, for CPU inference
+
+    ESM-1b attention calls the fused torch attention with the projection
+    weights, which quantized layers do not expose, so it is switched to the
+    module path.
+    """
+    for module in model.modules():
+        if hasattr(module, "enable_torch_version"):
+            module.enable_torch_version = False
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def token_length(sequence, alphabet):
+    """Number of tokens of a sequence, including the BOS/EOS tokens"""
+    return len(sequence) + int(alphabet.prepend_bos) + int(alphabet.append_eos)
+
+
+def fixed_size_batches(n_sequences, batch_size):
+    """Batches of batch_size consecutive indices, in input order"""
+    return [
+        list(range(start, min(start + batch_size, n_sequences)))
+        for start in range(0, n_sequences, batch_size)
+    ]
+
+
+def token_budget_batches(lengths, max_tokens):
+    """Pack sequence indices into batches of at most max_tokens padded tokens
+
+    Sequences are sorted by length so each batch holds sequences of similar
+    length and little padding; the padded size of a batch is its number of
+    sequences times its longest length. A sequence longer than max_tokens gets
+    a batch on its own.
+    """
+    batches = []
+    batch = []
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # sorted ascending, so the new sequence is the longest of the batch
+        if batch and (len(batch) + 1) * lengths[index] > max_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def window_ranges(length, window_size=None, overlap=0):
+    """(start, stop, own_start, own_stop) windows covering a sequence of `length` residues
+
+    Consecutive windows share `overlap` residues (the last window is aligned
+    to the end of the sequence) and each residue is owned by exactly one
+    window: overlaps are split in the middle, so a residue's representation is
+    taken from the window where it has the most context. A sequence no longer
+    than window_size is one window.
+    """
+    if window_size is None or length <= window_size:
+        return [(0, length, 0, length)]
+    stride = window_size - overlap
+    starts = list(range(0, length - window_size, stride)) + [length - window_size]
+    bounds = (
+        [0]
+        + [
+            (next_start + start + window_size) // 2
+            for start, next_start in zip(starts, starts[1:])
+        ]
+        + [length]
+    )
+    return [
+        (start, start + window_size, own_start, own_stop)
+        for start, own_start, own_stop in zip(starts, bounds, bounds[1:])
+    ]
+
+
+def residue_mask(tokens, alphabet):
+    """Boolean mask of the residue tokens, i.e. without padding and BOS/EOS"""
+    return (
+        (tokens != alphabet.padding_idx)
+        & (tokens != alphabet.cls_idx)
+        & (tokens != alphabet.eos_idx)
+    )
+
+
+def pool_representations(
+    representations, tokens, alphabet, pooling="residue_mean", owned=None
+):
+    """Mean-pool per-token representations (batch, tokens, dim) -> (batch, dim)
+
+    `residue_mean` averages the residue tokens only, so the embedding of a
+    sequence does not depend on the other sequences of its batch. `token_mean`
+    averages every position including BOS/EOS and padding, as earlier versions
+    of calculate-esm-to-embed did. `owned` optionally restricts each residue
+    mean to a (start, stop) range of residues, or None for all of them.
+    """
+    if pooling == "token_mean":
+        return torch.mean(representations, dim=1)
+    mask = residue_mask(tokens, alphabet)
+    if owned is not None:
+        offset = int(alphabet.prepend_bos)
+        positions = torch.arange(tokens.shape[1], device=tokens.device)
+        for j, owned_range in enumerate(owned):
+            if owned_range is not None:
+                own_start, own_stop = owned_range
+                mask[j] &= (positions >= own_start + offset) & (
+                    positions < own_stop + offset
+                )
+    mask = mask.unsqueeze(-1).to(representations.dtype)
+    return (representations * mask).sum(dim=1) / mask.sum(dim=1).clamp_min(1)
+
+
+def embed_tokens(
+    model,
+    alphabet,
+    batch_tokens,
+    device,
+    pooling="residue_mean",
+    repr_layer=DEFAULT_REPR_LAYER,
+    precision="fp32",
+    owned=None,
+):
+    """Pooled embeddings of a batch of tokens as a (batch, dim) float32 CPU tensor
+
+    With `bf16` the forward pass runs under bfloat16 autocast; pooling is
+    always done in float32, over the `owned` residues if given (see
+    pool_representations).
+    """
+    batch_tokens = batch_tokens.to(device)
+    with torch.no_grad(), torch.autocast(
+        device_type=batch_tokens.device.type,
+        dtype=torch.bfloat16,
+        enabled=precision == "bf16",
+    ):
+        results = model(batch_tokens, repr_layers=[repr_layer])["representations"][
+            repr_layer
+        ]  # batch_size, max_seq_len, embedding_size
+    results = results.to(torch.float32)
+    return pool_representations(
+        results, batch_tokens, alphabet, pooling, owned
+    ).cpu()
+
+
+class SequenceEmbedder:
+    """Embed (label, sequence) rows with an ESM model loaded on first use
+
+    Identical sequences are embedded once and, given an EmbeddingCache, cached
+    embeddings are reused and new ones added to the cache. `embed` returns the
+    embeddings in the input order and .pt layout, i.e. a list of
+    {"label": label, "mean_representations": {repr_layer: tensor}}. The model
+    only runs up to repr_layer, in the given precision. With tokenizer threads,
+    tokenization runs alongside the model (see iter_tokens and iter_embed_chunks);
+    with several processes, batches are embedded in parallel on the CPU by
+    workers forked once, when the model is loaded (see start_workers). With a window size, longer sequences are
+    embedded in overlapping windows batched with the other sequences, and
+    pooled over the residues each window owns (see window_ranges).
+    """
+
+    def __init__(
+        self,
+        esm_model,
+        device,
+        pooling="residue_mean",
+        batch_size=2,
+        max_tokens=None,
+        cache=None,
+        repr_layer=DEFAULT_REPR_LAYER,
+        precision="fp32",
+        tokenizer_threads=0,
+        processes=1,
+        threads_per_process=None,
+        pin_threads=False,
+        window_size=None,
+        window_overlap=0,
+    ):
+        self.esm_model = esm_model
+        self.repr_layer = repr_layer
+        self.precision = precision
+        self.tokenizer_threads = tokenizer_threads
+        self.tokenizer = None
+        if tokenizer_threads:
+            self.tokenizer = ThreadPoolExecutor(max_workers=tokenizer_threads)
+        self.processes = processes
+        self.threads_per_process = threads_per_process or max(
+            1, (os.cpu_count() or 1) // processes
+        )
+        self.pin_threads = pin_threads
+        self.window_size = window_size
+        self.window_overlap = window_overlap
+        self.device = device
+        self.pooling = pooling
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.cache = cache
+        self.model = None
+        self.workers = None
+
+    def load(self):
+        if self.model is None:
+            model, self.alphabet = load_esm_model(self.esm_model)
+            model = truncate_model(model, self.repr_layer)
+            self.batch_converter = self.alphabet.get_batch_converter()
+            self.model = model.to(self.device)  # move the model to GPU
+            self.model.eval()
+            if self.precision == "int8":
+                self.model = quantize_model(self.model)
+            if self.processes > 1:
+                self.workers = self.start_workers()
+
+    def start_workers(self):
+        """Fork the worker processes, once, right after the model is loaded
+
+        Forking before any inference or tokenizer thread starts keeps the
+        workers clear of locks held by other threads, and the workers share the
+        model weights copy-on-write. Each worker runs threads_per_process torch
+        threads, pinned to its own cores with pin_threads.
+        """
+        _EMBEDDING_JOB["embedder"] = self
+        context = multiprocessing.get_context("fork")
+        workers = ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=context,
+            initializer=init_embedding_worker,
+            initargs=(context.Value("i", 0), self.threads_per_process, self.pin_threads),
+        )
+        # the first task forks all the workers
+        workers.submit(os.getpid).result()
+        LOG.info(f"Started {self.processes} embedding worker processes")
+        return workers
+
+    def batches(self, sequences):
+        if self.max_tokens is None:
+            return fixed_size_batches(len(sequences), self.batch_size)
+        lengths = [token_length(sequence, self.alphabet) for sequence in sequences]
+        batches = token_budget_batches(lengths, self.max_tokens)
+        LOG.info(
+            f"Packed {len(sequences)} sequences into {len(batches)} length-sorted batches of at most {self.max_tokens} tokens"
+        )
+        return batches
+
+    def tokenize(self, batch):
+        _, _, batch_tokens = self.batch_converter(batch)
+        return batch_tokens
+
+    def iter_tokens(self, batches):
+        """Tokenize batches of (label, sequence), on the tokenizer threads if any
+
+        With tokenizer threads, up to two batches per thread are tokenized and
+        padded ahead of the one the model is working on.
+        """
+        if self.tokenizer is None:
+            for batch in batches:
+                yield self.tokenize(batch)
+            return
+        pending = deque()
+        for batch in batches:
+            pending.append(self.tokenizer.submit(self.tokenize, batch))
+            if len(pending) > 2 * self.tokenizer_threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def iter_pooled(self, rows, model, precision):
+        """Yield (row indices, pooled embeddings) of (key, label, sequence, owned) rows, batch by batch"""
+        batches = self.batches([sequence for _, _, sequence, _ in rows])
+        # the workers hold the embedder's model, other models (i.e. the fp32
+        # reference of an int8 check_precision) run in this process
+        if self.workers is not None and model is self.model:
+            yield from self.iter_pooled_in_processes(rows, batches, precision)
+            return
+        token_batches = self.iter_tokens(
+            [rows[index][1:3] for index in batch_indices] for batch_indices in batches
+        )
+        for batch_indices, batch_tokens in zip(tqdm(batches), token_batches):
+            yield batch_indices, embed_tokens(
+                model,
+                self.alphabet,
+                batch_tokens,
+                self.device,
+                self.pooling,
+                self.repr_layer,
+                precision,
+                [rows[index][3] for index in batch_indices],
+            )  # batch_size, embedding_size
+
+    def iter_pooled_in_processes(self, rows, batches, precision):
+        """Same as iter_pooled, with batches embedded by the worker processes at `precision`"""
+        # longest batches first, so the workers finish together
+        batches = batches[::-1]
+        pooled = self.workers.map(
+            embed_in_worker,
+            (
+                (
+                    [rows[index][1:3] for index in batch_indices],
+                    [rows[index][3] for index in batch_indices],
+                    precision,
+                )
+                for batch_indices in batches
+            ),
+        )
+        yield from zip(tqdm(batches), pooled)
+
+    def iter_pooled_rows(self, rows, model, precision):
+        """Yield dicts key -> pooled embedding of (key, label, sequence) rows, batch by batch
+
+        Sequences longer than window_size are split into windows; the embedding
+        of such a sequence is the mean of the window means weighted by the
+        number of residues each window owns, yielded with its last window.
+        """
+        window_rows = []
+        windows_left = {}
+        lengths = {}
+        for key, label, sequence in rows:
+            windows = window_ranges(len(sequence), self.window_size, self.window_overlap)
+            if len(windows) == 1:
+                window_rows.append((key, label, sequence, None))
+                continue
+            windows_left[key] = len(windows)
+            lengths[key] = len(sequence)
+            for start, stop, own_start, own_stop in windows:
+                window_rows.append(
+                    (key, label, sequence[start:stop], (own_start - start, own_stop - start))
+                )
+        if windows_left:
+            LOG.info(
+                f"Split {len(windows_left)} sequences longer than {self.window_size} residues into {len(window_rows) - len(rows) + len(windows_left)} windows"
+            )
+        sums = {}
+        for batch_indices, avg_x in self.iter_pooled(window_rows, model, precision):
+            batch_pooled = {}
+            for j, index in enumerate(batch_indices):
+                key, _, _, owned = window_rows[index]
+                if owned is None:
+                    batch_pooled[key] = avg_x[j]
+                    continue
+                sums[key] = sums.get(key, 0) + avg_x[j] * (owned[1] - owned[0])
+                windows_left[key] -= 1
+                if not windows_left[key]:
+                    batch_pooled[key] = sums.pop(key) / lengths[key]
+            yield batch_pooled
+
+    def embed_unique(self, rows):
+        """Pooled embeddings of (md5, label, sequence) rows as a dict md5 -> tensor"""
+        self.load()
+        pooled = {}
+        for batch_pooled in self.iter_pooled_rows(rows, self.model, self.precision):
+            if self.cache is not None:
+                self.cache.put_many(batch_pooled)
+            pooled.update(batch_pooled)
+        return pooled
+
+    def check_precision(self, labels, sequences, n_sample=64, seed=2023):
+        """Compare the embeddings of a sample of sequences with fp32 embeddings
+
+        Returns the median and maximum relative error of the embeddings and,
+        per metric, the drift of the pairwise distances between them (see
+        dim_reduction.distance_distortion).
+        """
+        self.load()
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(len(sequences), min(n_sample, len(sequences)), replace=False)
+        rows = [(index, labels[index], sequences[index]) for index in sorted(sample)]
+        if self.precision == "int8":
+            reference_model, _ = load_esm_model(self.esm_model)
+            reference_model = truncate_model(reference_model, self.repr_layer)
+            reference_model = reference_model.to(self.device).eval()
+        else:
+            reference_model = self.model
+        embeddings = {}
+        for model, precision in [(reference_model, "fp32"), (self.model, self.precision)]:
+            pooled = {}
+            for batch_pooled in self.iter_pooled_rows(rows, model, precision):
+                pooled.update(batch_pooled)
+            embeddings[precision] = torch.stack(
+                [pooled[index] for index, _, _ in rows]
+            ).to(torch.float64)
+        reference, reduced = embeddings["fp32"], embeddings[self.precision]
+        relative_error = torch.linalg.norm(reduced - reference, dim=1) / torch.linalg.norm(
+            reference, dim=1
+        ).clamp_min(1e-12)
+        return {
+            "median_relative_error": float(relative_error.median()),
+            "max_relative_error": float(relative_error.max()),
+            "distances": distance_distortion(
+                reference,
+                reduced,
+                ["euclidean", "cosine"],
+                n_pairs=len(rows) * (len(rows) - 1) // 2,
+                seed=seed,
+            ),
+        }
+
+    def embed(self, labels, sequences):
+        # ESM reads lower-case residues as unknown, and the cache keys the upper-case sequence
+        sequences = [sequence.upper() for sequence in sequences]
+        # identical sequences are embedded once, at their first row
+        md5s = [sequence_md5(sequence) for sequence in sequences]
+        unique_rows = {}
+        for md5, label, sequence in zip(md5s, labels, sequences):
+            unique_rows.setdefault(md5, (md5, label, sequence))
+        pooled = {}
+        if self.cache is not None:
+            pooled.update(self.cache.get_many(unique_rows))
+        todo = [row for md5, row in unique_rows.items() if md5 not in pooled]
+        LOG.info(
+            f"{len(md5s)} sequences, {len(unique_rows)} unique, {len(pooled)} cached, {len(todo)} to embed"
+        )
+        if todo:
+            pooled.update(self.embed_unique(todo))
+        return [
+            {"label": label, "mean_representations": {self.repr_layer: pooled[md5]}}
+            for label, md5 in zip(labels, md5s)
+        ]
+
+    def iter_embed_chunks(self, chunks):
+        """Embed an iterator of (labels, sequences) chunks, yielding the embeddings of each
+
+        With tokenizer threads the next chunk is read on a background thread
+        while the current one is embedded.
+        """
+        # load (and fork the workers) before the prefetch thread starts
+        self.load()
+        if self.tokenizer is not None:
+            chunks = iter_prefetched(chunks, 1)
+        for labels, sequences in chunks:
+            yield self.embed(labels, sequences)
+
+    def close(self):
+        if self.tokenizer is not None:
+            self.tokenizer.shutdown()
+        if self.workers is not None:
+            self.workers.shutdown()
+            self.workers = None
+            _EMBEDDING_JOB.clear()
+
+
+def init_embedding_worker(counter, threads, pin_threads):
+    """Set the torch threads of a worker and, optionally, pin it to its own cores"""
+    with counter.get_lock():
+        worker = counter.value
+        counter.value += 1
+    torch.set_num_threads(threads)
+    if pin_threads and hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        worker_cores = cores[worker * threads : (worker + 1) * threads]
+        if worker_cores:
+            os.sched_setaffinity(0, worker_cores)
+
+
+def embed_in_worker(job):
+    """Pooled embeddings of a (batch of (label, sequence), owned ranges, precision) job with the embedder's model"""
+    batch, owned, precision = job
+    embedder = _EMBEDDING_JOB["embedder"]
+    return embed_tokens(
+        embedder.model,
+        embedder.alphabet,
+        embedder.tokenize(batch),
+        embedder.device,
+        embedder.pooling,
+        embedder.repr_layer,
+        precision,
+        owned,
+    )
+
+
+def iter_prefetched(iterable, size):
+    """Iterate over `iterable` on a background thread, keeping up to `size` items ready"""
+    items = queue.Queue(maxsize=size)
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((True, item))
+            items.put((False, None))
+        except Exception as error:
+            items.put((False, error))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        ok, item = items.get()
+        if ok:
+            yield item
+        elif item is None:
+            return
+        else:
+            raise item
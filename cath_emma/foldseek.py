@@ -0,0 +1,85 @@
+import logging
+from array import array
+import numpy as np
+from .distance_engine import DEFAULT_DISTANCE
+
+LOG = logging.getLogger(__name__)
+
+
+class FoldseekHits:
+    """Foldseek hits between labels stored as a CSR-like sorted pair array
+
+    Each unordered pair of labels (i < j in label order) keeps a single bitscore:
+    the last query i -> target j hit if there is one, otherwise the last j -> i hit.
+    Hits are buffered as compact int32 arrays (12 bytes per hit) while streaming.
+    """
+
+    def __init__(self, n_labels, rows, cols, bitscores):
+        self.n_labels = n_labels
+        self.rows = rows
+        self.cols = cols
+        self.bitscores = bitscores
+        self.indptr = np.searchsorted(rows, np.arange(n_labels + 1))
+
+    def __len__(self):
+        return len(self.rows)
+
+    @classmethod
+    def from_m8(cls, foldseek_output_fh, label_index):
+        """Stream a Foldseek m8 file (query, target, ..., bitscore) into pairs"""
+        label_ids = label_index.ids
+        queries, targets, bitscores = array("i"), array("i"), array("i")
+        skipped = 0
+        for line in foldseek_output_fh:
+            results = line.split()
+            if not results:
+                continue
+            query = label_ids.get(results[0])
+            target = label_ids.get(results[1])
+            if query is None or target is None:
+                skipped += 1
+                continue
+            if query == target:
+                continue
+            queries.append(query)
+            targets.append(target)
+            bitscores.append(int(results[-1]))
+        if skipped:
+            LOG.warning(f"Skipped {skipped} Foldseek hits for labels not in the labels file")
+        queries = np.frombuffer(queries, dtype=np.int32)
+        targets = np.frombuffer(targets, dtype=np.int32)
+        bitscores = np.frombuffer(bitscores, dtype=np.int32)
+        forward = queries < targets
+        lo = np.minimum(queries, targets)
+        hi = np.maximum(queries, targets)
+        del queries, targets
+        n_hits = len(lo)
+        # the sort is stable, so the last entry of each pair is its last forward
+        # hit if there is one, otherwise its last hit
+        order = np.lexsort((forward, hi, lo))
+        del forward
+        lo = lo[order]
+        hi = hi[order]
+        bitscores = bitscores[order]
+        del order
+        last = np.ones(n_hits, dtype=bool)
+        last[:-1] = (lo[1:] != lo[:-1]) | (hi[1:] != hi[:-1])
+        LOG.info(f"Read {n_hits} Foldseek hits covering {int(last.sum())} label pairs")
+        return cls(len(label_index), lo[last], hi[last], bitscores[last])
+
+    def iter_row_bands(self, band_size):
+        """Yield (start, band) of 1/bitscore distances, DEFAULT_DISTANCE elsewhere
+
+        Hits with a bitscore of 0 or less are at DEFAULT_DISTANCE too.
+        """
+        n_labels = self.n_labels
+        for start in range(0, n_labels, band_size):
+            stop = min(start + band_size, n_labels)
+            band = np.full((stop - start, n_labels), DEFAULT_DISTANCE, dtype=np.float64)
+            band[np.arange(stop - start), np.arange(start, stop)] = 0.0
+            hits = slice(self.indptr[start], self.indptr[stop])
+            bitscores = self.bitscores[hits]
+            band[self.rows[hits] - start, self.cols[hits]] = np.where(
+                bitscores > 0, 1 / np.maximum(bitscores, 1), DEFAULT_DISTANCE
+            )
+            yield start, band
@@ -0,0 +1,9 @@
+import os
+
+
+def save_atomic(path, save):
+    """Call save(tmp_path) then move the result into place, so a killed task
+    never leaves a partial file behind"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    save(tmp_path)
+    os.replace(tmp_path, path)
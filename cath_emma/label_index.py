@@ -0,0 +1,63 @@
+import logging
+
+LOG = logging.getLogger(__name__)
+
+
+class LabelIndex:
+    """Ordered mapping between labels (sequence identifiers) and integer ids
+
+    On disk a label index is one label per line, the line number (from 0) being
+    the id, so the `${PROJECT}_ids_list` files are valid label indexes.
+    """
+
+    def __init__(self, labels):
+        self.labels = []
+        self.ids = {}
+        for label in labels:
+            if label in self.ids:
+                LOG.warning(f"Ignoring duplicate label {label}")
+                continue
+            self.ids[label] = len(self.labels)
+            self.labels.append(label)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    def __contains__(self, label):
+        return label in self.ids
+
+    def id_of(self, label):
+        return self.ids[label]
+
+    def label_of(self, label_id):
+        return self.labels[label_id]
+
+    @classmethod
+    def read(cls, labels_fh):
+        """Read a label index (one label per line, blank lines ignored)"""
+        return cls(label for label in (line.rstrip() for line in labels_fh) if label)
+
+    @classmethod
+    def read_path(cls, labels_path):
+        with open(labels_path, "rt") as labels_fh:
+            return cls.read(labels_fh)
+
+    @classmethod
+    def from_reps_csv(cls, cluster_reps_fh):
+        """Build the index from the first column of a ${PROJECT}_reps.csv file"""
+        return cls(
+            line.split(",", 1)[0].rstrip()
+            for line in cluster_reps_fh
+            if line.strip()
+        )
+
+    def write(self, labels_fh):
+        for label in self.labels:
+            labels_fh.write(f"{label}\n")
+
+    def write_path(self, labels_path):
+        with open(labels_path, "wt") as labels_fh:
+            self.write(labels_fh)
@@ -0,0 +1,291 @@
+import gzip
+import json
+import logging
+import multiprocessing
+import operator
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .distance_engine import DEFAULT_DISTANCE
+from .io_utils import save_atomic
+from .label_index import LabelIndex
+
+LOG = logging.getLogger(__name__)
+
+MATRIX_DTYPES = {"float32": np.float32, "float16": np.float16}
+MATRIX_COMPRESSIONS = ["none", "gzip", "zstd"]
+# distances formatted per SSV chunk, i.e. about 40 MB of text
+SSV_CHUNK_VALUES = 1 << 20
+
+# Formatter of the current SSV writer, inherited by the formatting workers
+_SSV_FORMATTER = None
+
+
+def write_sparse_ssv(matrix_output_file, labels_list, rows, cols, distances):
+    """Write listed pairs only, once per unordered pair and in label order
+
+    Pairs not in the file are implicitly at the default distance.
+    """
+    n = len(labels_list)
+    lo = np.minimum(rows, cols).astype(np.int64)
+    hi = np.maximum(rows, cols).astype(np.int64)
+    pair_keys, first = np.unique(lo * n + hi, return_index=True)
+    values = distances[first].astype(str)
+    for key, value in zip(pair_keys.tolist(), values):
+        i, j = divmod(key, n)
+        matrix_output_file.write(f">{labels_list[i]} >{labels_list[j]} {value}\n")
+    LOG.info(f"Wrote {len(pair_keys)} neighbour pairs for {n} labels")
+
+
+def condensed_size(n):
+    """Number of entries of the upper triangle (diagonal included) of an n x n matrix"""
+    return n * (n + 1) // 2
+
+
+def condensed_offset(i, n):
+    """Position of the diagonal entry (i, i) in the condensed array"""
+    return i * n - i * (i - 1) // 2
+
+
+def labels_path_of(matrix_path):
+    return f"{matrix_path}.labels"
+
+
+def metadata_path_of(matrix_path):
+    return f"{matrix_path}.meta.json"
+
+
+class SsvFormatter:
+    """Format row bands as legacy '>label1 >label2 dist' lines
+
+    Distances are written as the repr of their float64 value, as the original
+    per-pair writer did, and the default distance as '100'.
+    """
+
+    def __init__(self, labels_list):
+        self.line_starts = [f">{label}" for label in labels_list]
+        self.col_labels = [f" >{label} " for label in labels_list]
+
+    def format_band(self, start, band, first_col=0):
+        """Lines of the rows start, start+1, ... of a band whose columns begin at first_col"""
+        rows = []
+        for offset in range(band.shape[0]):
+            i = start + offset
+            row = band[offset, i - first_col :]
+            values = row.astype(np.float64).astype(str)
+            values[row == DEFAULT_DISTANCE] = str(DEFAULT_DISTANCE)
+            line_start = self.line_starts[i]
+            rows.append(
+                line_start
+                + f"\n{line_start}".join(
+                    map(operator.add, self.col_labels[i:], values.tolist())
+                )
+                + "\n"
+            )
+        return "".join(rows).encode()
+
+
+def _init_ssv_formatter(formatter):
+    global _SSV_FORMATTER
+    _SSV_FORMATTER = formatter
+
+
+def _format_ssv_band(start, band, first_col):
+    return _SSV_FORMATTER.format_band(start, band, first_col)
+
+
+def open_compressed(path, compression="none"):
+    """Binary output file, optionally through a streaming gzip/zstd compressor"""
+    if compression == "gzip":
+        return gzip.open(path, "wb", compresslevel=6)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError as err:
+            raise ImportError("zstd compression requires the 'zstandard' package") from err
+        return zstandard.ZstdCompressor(threads=-1).stream_writer(open(path, "wb"))
+    return open(path, "wb")
+
+
+class SsvMatrixWriter:
+    """Write distance bands as a legacy SSV text matrix
+
+    Bands are formatted in chunks of rows of about SSV_CHUNK_VALUES upper
+    triangle distances, so the text in memory stays bounded whatever the band
+    size. With processes > 1 the chunks are formatted by a pool of worker
+    processes and written in order as they complete. The workers are started from a
+    forkserver, as the writer is usually opened once torch (and its thread
+    pools or CUDA) is initialised, which forked children would inherit.
+    """
+
+    def __init__(self, matrix_path, labels_list, processes=1, compression="none"):
+        self.matrix_path = matrix_path
+        self.formatter = SsvFormatter(labels_list)
+        self.matrix_output_file = open_compressed(matrix_path, compression)
+        self.processes = processes
+        self.pending = deque()
+        self.executor = None
+        if processes > 1:
+            self.executor = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context("forkserver"),
+                initializer=_init_ssv_formatter,
+                initargs=(self.formatter,),
+            )
+
+    def write_band(self, start, band):
+        n_cols = band.shape[1]
+        offset = 0
+        while offset < band.shape[0]:
+            row = start + offset
+            n_rows = max(1, SSV_CHUNK_VALUES // max(1, n_cols - row))
+            # only the upper triangle of the chunk is formatted
+            chunk = band[offset : offset + n_rows, row:]
+            offset += n_rows
+            if self.executor is None:
+                self.matrix_output_file.write(self.formatter.format_band(row, chunk, row))
+                continue
+            self.pending.append(self.executor.submit(_format_ssv_band, row, chunk, row))
+            while len(self.pending) > 2 * self.processes:
+                self.matrix_output_file.write(self.pending.popleft().result())
+
+    def close(self):
+        while self.pending:
+            self.matrix_output_file.write(self.pending.popleft().result())
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.matrix_output_file.close()
+        LOG.info(f"Wrote SSV matrix -> {self.matrix_path}")
+
+
+class CondensedMatrixWriter:
+    """Write distance bands into a memory-mapped condensed upper-triangle array
+
+    The array holds the upper triangle including the diagonal, row by row, so
+    entry k is the distance written on line k of the legacy SSV file. The labels
+    are stored one per line next to the array (<matrix>.labels), and the dtype
+    with the given metadata (i.e. metric and embedding hash of each label) in
+    <matrix>.meta.json, so later runs know what they may reuse.
+    """
+
+    def __init__(self, matrix_path, labels_list, dtype="float32", metadata=None):
+        self.matrix_path = matrix_path
+        self.metadata = {"dtype": dtype, **(metadata or {})}
+        self.n = len(labels_list)
+        self.array = np.lib.format.open_memmap(
+            matrix_path,
+            mode="w+",
+            dtype=MATRIX_DTYPES[dtype],
+            shape=(condensed_size(self.n),),
+        )
+        LabelIndex(labels_list).write_path(labels_path_of(matrix_path))
+
+    def write_band(self, start, band):
+        for offset in range(band.shape[0]):
+            i = start + offset
+            pos = condensed_offset(i, self.n)
+            self.array[pos : pos + self.n - i] = band[offset, i:]
+
+    def close(self):
+        self.array.flush()
+        del self.array
+
+        def save_metadata(path):
+            with open(path, "wt") as metadata_fh:
+                json.dump(self.metadata, metadata_fh)
+
+        save_atomic(metadata_path_of(self.matrix_path), save_metadata)
+        LOG.info(f"Wrote condensed {self.n}x{self.n} matrix -> {self.matrix_path}")
+
+
+class CondensedDistanceMatrix:
+    """Read-only, memory-mapped view of a condensed distance matrix"""
+
+    def __init__(self, matrix_path):
+        self.matrix_path = matrix_path
+        self.array = np.load(matrix_path, mmap_mode="r")
+        self.label_index = LabelIndex.read_path(labels_path_of(matrix_path))
+        self.labels = self.label_index.labels
+        self.n = len(self.labels)
+        if len(self.array) != condensed_size(self.n):
+            raise ValueError(
+                f"{matrix_path} holds {len(self.array)} distances, expected {condensed_size(self.n)} for {self.n} labels"
+            )
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def metadata(self):
+        """Dtype, metric and embedding hashes the matrix was written with (None if unknown)"""
+        if not os.path.exists(metadata_path_of(self.matrix_path)):
+            return None
+        with open(metadata_path_of(self.matrix_path), "rt") as metadata_fh:
+            return json.load(metadata_fh)
+
+    def index(self, label):
+        """Position of a label (or pass-through of an integer position)"""
+        if isinstance(label, (int, np.integer)):
+            return int(label)
+        return self.label_index.id_of(label)
+
+    def distance(self, a, b):
+        i, j = sorted((self.index(a), self.index(b)))
+        return float(self.array[condensed_offset(i, self.n) + j - i])
+
+    def row(self, i):
+        """Distances from i to i, i+1, ..., n-1 (a view, no copy)"""
+        i = self.index(i)
+        pos = condensed_offset(i, self.n)
+        return self.array[pos : pos + self.n - i]
+
+    def diagonal(self):
+        """Self distances: 0 for labels with a value, the default distance otherwise"""
+        i = np.arange(self.n, dtype=np.int64)
+        return self.array[i * self.n - i * (i - 1) // 2]
+
+    def block(self, rows, cols):
+        """Distances between two ranges or arrays of positions
+
+        Always a copy, gathered through (rows x cols) int64 index arrays; to
+        stream large parts of the matrix, slice the row() views instead.
+        """
+        rows = np.arange(self.n)[rows] if isinstance(rows, slice) else np.asarray(rows)
+        cols = np.arange(self.n)[cols] if isinstance(cols, slice) else np.asarray(cols)
+        lo = np.minimum(rows[:, None], cols[None, :]).astype(np.int64)
+        hi = np.maximum(rows[:, None], cols[None, :]).astype(np.int64)
+        return self.array[lo * self.n - lo * (lo - 1) // 2 + hi - lo]
+
+    def iter_row_bands(self, band_size):
+        """Yield (start, band) row bands as produced by the distance engines"""
+        for start in range(0, self.n, band_size):
+            stop = min(start + band_size, self.n)
+            band = np.empty((stop - start, self.n), dtype=self.array.dtype)
+            for i in range(start, stop):
+                band[i - start, i:] = self.row(i)
+            yield start, band
+
+
+def open_matrix_writer(
+    matrix_path,
+    labels_list,
+    matrix_format="ssv",
+    dtype="float32",
+    processes=1,
+    compression="none",
+    metadata=None,
+):
+    """Writer for the requested matrix format, consuming (start, band) row bands
+
+    `metadata` (i.e. metric and embedding hashes) is recorded for binary matrices.
+    """
+    if matrix_format == "binary":
+        if compression != "none":
+            raise ValueError("Binary matrices are memory-mapped and cannot be compressed")
+        return CondensedMatrixWriter(
+            matrix_path, labels_list, dtype=dtype, metadata=metadata
+        )
+    return SsvMatrixWriter(
+        matrix_path, labels_list, processes=processes, compression=compression
+    )
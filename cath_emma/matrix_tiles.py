@@ -0,0 +1,96 @@
+import json
+import logging
+import os
+import numpy as np
+from .distance_engine import DEFAULT_DISTANCE
+from .io_utils import save_atomic
+from .label_index import LabelIndex
+
+LOG = logging.getLogger(__name__)
+
+LAYOUT_FILE = "tiles.json"
+LABELS_FILE = "labels"
+
+
+def upper_triangle_tiles(n_labels, tile_size):
+    """(row_block, col_block) of every tile of the upper triangle, row by row"""
+    n_blocks = -(-n_labels // tile_size)
+    return [
+        (row_block, col_block)
+        for row_block in range(n_blocks)
+        for col_block in range(row_block, n_blocks)
+    ]
+
+
+def tile_path(tile_dir, row_block, col_block):
+    return os.path.join(tile_dir, f"tile_{row_block}_{col_block}.npy")
+
+
+def write_tile_layout(tile_dir, labels_list, tile_size, metric):
+    os.makedirs(tile_dir, exist_ok=True)
+    layout = {"n_labels": len(labels_list), "tile_size": tile_size, "metric": metric}
+    layout_path = os.path.join(tile_dir, LAYOUT_FILE)
+    if os.path.exists(layout_path):
+        previous_layout = read_tile_layout(tile_dir)
+        previous_labels = read_tile_labels(tile_dir).labels
+        if previous_layout != layout or previous_labels != list(labels_list):
+            raise ValueError(
+                f"{tile_dir} holds tiles of another matrix ({previous_layout})"
+            )
+        return
+    save_atomic(
+        os.path.join(tile_dir, LABELS_FILE), LabelIndex(labels_list).write_path
+    )
+
+    def save_layout(path):
+        with open(path, "wt") as layout_fh:
+            json.dump(layout, layout_fh)
+
+    save_atomic(layout_path, save_layout)
+
+
+def read_tile_layout(tile_dir):
+    with open(os.path.join(tile_dir, LAYOUT_FILE), "rt") as layout_fh:
+        return json.load(layout_fh)
+
+
+def read_tile_labels(tile_dir):
+    return LabelIndex.read_path(os.path.join(tile_dir, LABELS_FILE))
+
+
+def write_tile(tile_dir, row_block, col_block, tile):
+    def save_tile(path):
+        with open(path, "wb") as tile_fh:
+            np.save(tile_fh, tile)
+
+    save_atomic(tile_path(tile_dir, row_block, col_block), save_tile)
+
+
+def missing_tiles(tile_dir, tiles):
+    return [tile for tile in tiles if not os.path.exists(tile_path(tile_dir, *tile))]
+
+
+def check_tiles_complete(tile_dir):
+    layout = read_tile_layout(tile_dir)
+    tiles = upper_triangle_tiles(layout["n_labels"], layout["tile_size"])
+    missing = missing_tiles(tile_dir, tiles)
+    if missing:
+        raise FileNotFoundError(
+            f"{len(missing)} of {len(tiles)} tiles missing in {tile_dir} (i.e. {tile_path(tile_dir, *missing[0])})"
+        )
+
+
+def iter_merged_row_bands(tile_dir):
+    """Yield (start, band) row bands of the full matrix assembled from the tiles"""
+    layout = read_tile_layout(tile_dir)
+    n_labels, tile_size = layout["n_labels"], layout["tile_size"]
+    n_blocks = -(-n_labels // tile_size)
+    for row_block in range(n_blocks):
+        start = row_block * tile_size
+        stop = min(start + tile_size, n_labels)
+        band = np.full((stop - start, n_labels), DEFAULT_DISTANCE, dtype=np.float32)
+        for col_block in range(row_block, n_blocks):
+            col_start = col_block * tile_size
+            tile = np.load(tile_path(tile_dir, row_block, col_block))
+            band[:, col_start : col_start + tile.shape[1]] = tile
+        yield start, band
@@ -0,0 +1,181 @@
+import logging
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+TRACE_FILE = "tree.trace"
+NEWICK_FILE = "tree.newick"
+
+
+class MergeTrace:
+    """Agglomerative tree as an array of merges, as in GeMMA tree.trace files
+
+    Leaves are the starting clusters 1..n (working_N, i.e. the label with id
+    N-1) and merge k (from 0) joins the two nodes of `pairs[k]` at
+    `distances[k]` into the new node n+1+k.
+    """
+
+    def __init__(self, n_leaves, pairs, distances):
+        self.n_leaves = n_leaves
+        self.pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        self.distances = np.asarray(distances, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.pairs)
+
+    @classmethod
+    def read(cls, trace_fh):
+        """Read '<node> <node> <merge node> <distance>' lines of a tree.trace file"""
+        pairs = []
+        distances = []
+        merge_nodes = []
+        for line in trace_fh:
+            if not line.strip():
+                continue
+            node_a, node_b, merge_node, distance = line.split()
+            pairs.append((int(node_a), int(node_b)))
+            merge_nodes.append(int(merge_node))
+            distances.append(float(distance))
+        n_leaves = merge_nodes[0] - 1 if merge_nodes else 1
+        if merge_nodes != list(range(n_leaves + 1, n_leaves + 1 + len(merge_nodes))):
+            raise ValueError(
+                f"Merge nodes of {getattr(trace_fh, 'name', 'the trace')} are not numbered {n_leaves + 1}, {n_leaves + 2}, ... in order"
+            )
+        return cls(n_leaves, pairs, distances)
+
+    @classmethod
+    def read_path(cls, trace_path):
+        with open(trace_path, "rt") as trace_fh:
+            return cls.read(trace_fh)
+
+    @classmethod
+    def from_slot_merges(cls, n_leaves, merges):
+        """Number the merges of a tree builder in order of distance
+
+        Builders report each merge as (slot_a, slot_b, distance), a slot being
+        the leaf whose position holds a cluster while it is built. Ties keep
+        the builder's order, so a node is always numbered after its children.
+        """
+        order = sorted(range(len(merges)), key=lambda k: merges[k][2])
+        parent = list(range(n_leaves))
+        node_of = list(range(1, n_leaves + 1))
+
+        def find(slot):
+            while parent[slot] != slot:
+                parent[slot] = parent[parent[slot]]
+                slot = parent[slot]
+            return slot
+
+        pairs = np.empty((len(merges), 2), dtype=np.int64)
+        distances = np.empty(len(merges), dtype=np.float64)
+        for k, merge in enumerate(order):
+            slot_a, slot_b, distance = merges[merge]
+            root_a, root_b = find(slot_a), find(slot_b)
+            pairs[k] = sorted((node_of[root_a], node_of[root_b]))
+            distances[k] = distance
+            parent[root_a] = root_b
+            node_of[root_b] = n_leaves + 1 + k
+        return cls(n_leaves, pairs, distances)
+
+    @property
+    def root(self):
+        return self.n_leaves + len(self.pairs) if len(self.pairs) else 1
+
+    def height(self, node):
+        return 0.0 if node <= self.n_leaves else float(self.distances[node - self.n_leaves - 1])
+
+    def write(self, trace_fh):
+        """Write '<node> <node> <merge node> <distance>' tab-separated lines"""
+        for k, ((node_a, node_b), distance) in enumerate(zip(self.pairs.tolist(), self.distances.tolist())):
+            trace_fh.write(f"{node_a}\t{node_b}\t{self.n_leaves + 1 + k}\t{distance:.8g}\n")
+
+    def write_newick(self, newick_fh):
+        """Write the tree in Newick format, branch lengths being height differences"""
+        tokens = []
+        # iterative depth-first walk, as chained merges are too deep to recurse
+        stack = [(self.root, None)]
+        while stack:
+            node, parent_height = stack.pop()
+            if isinstance(node, str):
+                tokens.append(node)
+                continue
+            length = "" if parent_height is None else f":{parent_height - self.height(node):.6g}"
+            if node <= self.n_leaves:
+                tokens.append(f"{node}{length}")
+                continue
+            node_a, node_b = self.pairs[node - self.n_leaves - 1].tolist()
+            tokens.append("(")
+            stack.append((f"){length}", None))
+            stack.append((node_b, self.height(node)))
+            stack.append((",", None))
+            stack.append((node_a, self.height(node)))
+        newick_fh.write("".join(tokens) + ";\n")
+
+    def iter_merge_members(self):
+        """Yield (merge node, leaves under it) in merge order"""
+        members = {}
+        for k, (node_a, node_b) in enumerate(self.pairs.tolist()):
+            merged = members.pop(node_a, [node_a]) + members.pop(node_b, [node_b])
+            node = self.n_leaves + 1 + k
+            members[node] = merged
+            yield node, merged
+
+    def clade_heights(self):
+        """Merge distances lowered to the lowest merge above them, so heights never increase from the root"""
+        heights = self.distances.copy()
+        for k in range(len(self.pairs) - 1, -1, -1):
+            for node in self.pairs[k].tolist():
+                if node > self.n_leaves:
+                    child = node - self.n_leaves - 1
+                    heights[child] = min(heights[child], heights[k])
+        return heights
+
+    def cut(self, thresholds):
+        """Flat clusters of the leaves at each distance threshold, in one pass over the merges
+
+        Returns an (n thresholds, n leaves) int32 array: row t holds the cluster
+        (from 1, numbered in order of their first leaf) of each leaf once every
+        merge at or below thresholds[t] is made. Clusters are the clades met
+        descending from the root: a merge below an inversion (a parent lower
+        than its child) is only made once its parent is.
+        """
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        clusters = np.empty((len(thresholds), self.n_leaves), dtype=np.int32)
+        parent = list(range(self.n_leaves))
+        # a leaf of each node, to join nodes by their leaves
+        leaf_of = list(range(self.n_leaves)) + [0] * len(self.pairs)
+
+        def find(leaf):
+            while parent[leaf] != leaf:
+                parent[leaf] = parent[parent[leaf]]
+                leaf = parent[leaf]
+            return leaf
+
+        pairs = self.pairs.tolist()
+        distances = self.clade_heights().tolist()
+        order = np.argsort(distances, kind="stable").tolist()
+        for k in range(len(pairs)):
+            leaf_of[self.n_leaves + k] = leaf_of[pairs[k][0] - 1]
+        merged = 0
+        for t in np.argsort(thresholds, kind="stable").tolist():
+            while merged < len(order) and distances[order[merged]] <= thresholds[t]:
+                node_a, node_b = pairs[order[merged]]
+                root_a, root_b = find(leaf_of[node_a - 1]), find(leaf_of[node_b - 1])
+                parent[root_a] = root_b
+                merged += 1
+            clusters[t] = flat_clusters(np.array(parent, dtype=np.int64))
+        return clusters
+
+
+def flat_clusters(parent):
+    """Cluster numbers (from 1, in order of first leaf) of a union-find parent array"""
+    roots = parent
+    while True:
+        next_roots = roots[roots]
+        if np.array_equal(next_roots, roots):
+            break
+        roots = next_roots
+    _, first, inverse = np.unique(roots, return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=np.int32)
+    rank[np.argsort(first)] = np.arange(1, len(first) + 1, dtype=np.int32)
+    return rank[inverse]
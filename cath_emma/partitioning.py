@@ -0,0 +1,231 @@
+import logging
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from .distance_engine import DEFAULT_DISTANCE, BlockedDistanceEngine
+from .merge_trace import MergeTrace
+from .tree_builder import nn_chain_linkage, pair_index
+
+LOG = logging.getLogger(__name__)
+
+# 20000 labels need 1.6 GB of float64 pair distances, well within a 16G job
+DEFAULT_MAX_PARTITION_SIZE = 20000
+DEFAULT_KMEANS_BATCH_SIZE = 1024
+DEFAULT_KMEANS_ITERATIONS = 100
+
+# Partition job of this process, set directly or by init_partition_worker in worker processes
+_PARTITION_JOB = {}
+
+
+def nearest_centroids(matrix, centroids, chunk_size=8192):
+    """Index of the nearest (euclidean) centroid of each row"""
+    centroid_sq_norms = (centroids * centroids).sum(axis=1)
+    nearest = np.empty(len(matrix), dtype=np.int64)
+    for start in range(0, len(matrix), chunk_size):
+        rows = np.asarray(matrix[start : start + chunk_size], dtype=np.float64)
+        # |x|^2 is the same for all centroids of a row
+        nearest[start : start + len(rows)] = np.argmin(
+            centroid_sq_norms[None, :] - 2 * rows @ centroids.T, axis=1
+        )
+    return nearest
+
+
+def minibatch_kmeans(
+    matrix,
+    n_clusters,
+    batch_size=DEFAULT_KMEANS_BATCH_SIZE,
+    iterations=DEFAULT_KMEANS_ITERATIONS,
+    seed=2023,
+):
+    """Mini-batch k-means (Sculley, 2010) of the rows of an (n, dim) array
+
+    Each centroid moves towards the batch rows assigned to it with a learning
+    rate of 1 / (rows assigned so far), i.e. it is the running mean of its rows.
+    Returns the centroids and the nearest centroid of every row.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(matrix)
+    centroids = np.array(matrix[np.sort(rng.choice(n, n_clusters, replace=False))], dtype=np.float64)
+    counts = np.zeros(n_clusters)
+    for _ in range(iterations):
+        batch = np.asarray(matrix[np.sort(rng.choice(n, min(batch_size, n), replace=False))], dtype=np.float64)
+        nearest = nearest_centroids(batch, centroids)
+        batch_counts = np.bincount(nearest, minlength=n_clusters)
+        batch_sums = np.zeros_like(centroids)
+        np.add.at(batch_sums, nearest, batch)
+        counts += batch_counts
+        moved = batch_counts > 0
+        centroids[moved] += (
+            batch_sums[moved] - batch_counts[moved, None] * centroids[moved]
+        ) / counts[moved, None]
+    return centroids, nearest_centroids(matrix, centroids)
+
+
+def partition_rows(
+    matrix,
+    max_size,
+    batch_size=DEFAULT_KMEANS_BATCH_SIZE,
+    iterations=DEFAULT_KMEANS_ITERATIONS,
+    seed=2023,
+):
+    """Split the rows of a matrix into partitions of at most max_size rows
+
+    Rows are split with mini-batch k-means into twice as many clusters as
+    needed on average, and oversized clusters are split again. Returns the
+    row arrays of the partitions, ordered by their first row.
+    """
+    partitions = []
+    todo = [np.arange(len(matrix))]
+    while todo:
+        rows = todo.pop()
+        if len(rows) <= max_size:
+            partitions.append(rows)
+            continue
+        n_clusters = min(len(rows), 2 * math.ceil(len(rows) / max_size))
+        _, nearest = minibatch_kmeans(matrix[rows], n_clusters, batch_size, iterations, seed)
+        clusters = [rows[nearest == cluster] for cluster in range(n_clusters)]
+        clusters = [cluster for cluster in clusters if len(cluster)]
+        if len(clusters) == 1:
+            # identical rows cannot be told apart, split them in input order
+            clusters = np.array_split(rows, math.ceil(len(rows) / max_size))
+        todo.extend(clusters)
+    return sorted(partitions, key=lambda rows: rows[0])
+
+
+def pair_distances(matrix, metric):
+    """Float64 pair distances (condensed, without the diagonal) of the rows of a matrix"""
+    n = len(matrix)
+    engine = BlockedDistanceEngine(matrix, metrics=[metric])
+    distances = np.empty(n * (n - 1) // 2, dtype=np.float64)
+    for start, (band,) in engine.iter_row_bands(np.arange(n)):
+        for offset in range(band.shape[0]):
+            i = start + offset
+            if i < n - 1:
+                first = pair_index(i, i + 1, n)
+                distances[first : first + n - i - 1] = band[offset, i + 1 :]
+    return distances
+
+
+def build_partition_tree(partition):
+    """Exact tree of one partition of the current job"""
+    rows = _PARTITION_JOB["partitions"][partition]
+    distances = pair_distances(
+        _PARTITION_JOB["matrix"][torch.as_tensor(rows)], _PARTITION_JOB["metric"]
+    )
+    trace = nn_chain_linkage(distances, len(rows), _PARTITION_JOB["linkage"])
+    return trace.pairs, trace.distances
+
+
+def init_partition_worker(matrix, partitions, metric, linkage, threads=None):
+    if threads is not None:
+        torch.set_num_threads(threads)
+    _PARTITION_JOB["matrix"] = matrix
+    _PARTITION_JOB["partitions"] = partitions
+    _PARTITION_JOB["metric"] = metric
+    _PARTITION_JOB["linkage"] = linkage
+
+
+def iter_partition_trees(matrix, partitions, metric, linkage, processes=1):
+    """Yield the MergeTrace of each partition, in order, built by `processes` workers"""
+    if processes > 1:
+        # workers start from a forkserver, as torch has run threads by now (k-means,
+        # centroids), and receive the embeddings through shared memory
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=init_partition_worker,
+            initargs=(
+                matrix.share_memory_(),
+                partitions,
+                metric,
+                linkage,
+                max(1, (os.cpu_count() or 1) // processes),
+            ),
+        ) as executor:
+            for rows, (pairs, distances) in zip(
+                partitions, executor.map(build_partition_tree, range(len(partitions)))
+            ):
+                yield MergeTrace(len(rows), pairs, distances)
+    else:
+        init_partition_worker(matrix, partitions, metric, linkage)
+        for partition, rows in enumerate(partitions):
+            yield MergeTrace(len(rows), *build_partition_tree(partition))
+
+
+def leaf_slot_merges(trace, slots):
+    """Merges of a trace as (slot_a, slot_b, distance), leaf i being slots[i - 1]"""
+    leaf_of = list(slots) + [0] * len(trace)
+    merges = []
+    for k, ((node_a, node_b), distance) in enumerate(
+        zip(trace.pairs.tolist(), trace.distances.tolist())
+    ):
+        leaf_of[trace.n_leaves + k] = leaf_of[node_a - 1]
+        merges.append((leaf_of[node_a - 1], leaf_of[node_b - 1], distance))
+    return merges
+
+
+def partitioned_linkage(
+    matrix,
+    positions,
+    metric="euclidean",
+    linkage="average",
+    max_size=DEFAULT_MAX_PARTITION_SIZE,
+    processes=1,
+    batch_size=DEFAULT_KMEANS_BATCH_SIZE,
+    iterations=DEFAULT_KMEANS_ITERATIONS,
+    seed=2023,
+):
+    """Two-level tree of the labels: exact trees of k-means partitions joined by a centroid tree
+
+    `matrix` holds the stacked embeddings and `positions`, for each label, its
+    row (-1 if missing). Each partition of at most `max_size` labels gets the
+    exact tree of its distances; the partitions are then joined by the tree of
+    their centroids, each joining merge being placed no lower than the merges
+    under it so the tree stays monotone. Labels without embedding are joined
+    last at the default distance. Returns the MergeTrace and the partition of
+    each label (-1 if missing).
+    """
+    if not len(matrix):
+        raise ValueError("No embeddings to partition")
+    label_of_row = np.empty(len(matrix), dtype=np.int64)
+    label_of_row[positions[positions >= 0]] = np.flatnonzero(positions >= 0)
+    points = matrix.to(torch.float32)
+    if metric == "cosine":
+        # k-means on unit vectors follows the cosine distance
+        points = points / points.norm(dim=1, keepdim=True).clamp_min(1e-8)
+    partitions = partition_rows(points.numpy(), max_size, batch_size, iterations, seed)
+    LOG.info(
+        f"Split {len(matrix)} embeddings into {len(partitions)} partitions of at most {max_size} (largest: {max(map(len, partitions), default=0)})"
+    )
+    merges = []
+    root_heights = []
+    for partition, trace in enumerate(
+        iter_partition_trees(matrix, partitions, metric, linkage, processes)
+    ):
+        merges.extend(leaf_slot_merges(trace, label_of_row[partitions[partition]]))
+        root_heights.append(float(trace.distances[-1]) if len(trace) else 0.0)
+        LOG.info(f"Built tree of partition {partition + 1}/{len(partitions)} ({len(partitions[partition])} labels)")
+
+    centroids = torch.stack([matrix[torch.as_tensor(rows)].to(torch.float64).mean(dim=0) for rows in partitions])
+    top = nn_chain_linkage(pair_distances(centroids, metric), len(partitions), linkage)
+    heights = root_heights + [0.0] * len(top)
+    for k, ((node_a, node_b), distance) in enumerate(zip(top.pairs.tolist(), top.distances.tolist())):
+        heights[top.n_leaves + k] = max(distance, heights[node_a - 1], heights[node_b - 1])
+    top = MergeTrace(top.n_leaves, top.pairs, heights[top.n_leaves :])
+    merges.extend(leaf_slot_merges(top, [label_of_row[rows[0]] for rows in partitions]))
+
+    missing = np.flatnonzero(positions < 0).tolist()
+    if missing:
+        LOG.warning(f"Joining {len(missing)} labels without embedding at the default distance")
+        last_height = max(heights, default=0.0)
+        slots = [label_of_row[partitions[0][0]]] + missing
+        merges.extend(
+            (a, b, max(DEFAULT_DISTANCE, last_height)) for a, b in zip(slots[:-1], slots[1:])
+        )
+    partition_of_label = np.full(len(positions), -1, dtype=np.int64)
+    for partition, rows in enumerate(partitions):
+        partition_of_label[label_of_row[rows]] = partition
+    return MergeTrace.from_slot_merges(len(positions), merges), partition_of_label
@@ -0,0 +1,350 @@
+import csv
+import heapq
+import logging
+import numpy as np
+import pandas as pd
+from .distance_engine import DEFAULT_DISTANCE
+from .matrix_io import CondensedDistanceMatrix
+from .merge_trace import MergeTrace
+
+LOG = logging.getLogger(__name__)
+
+LINKAGES = ["average", "single", "complete"]
+TREE_BUILDERS = ["nn_chain", "windowed", "sparse"]
+DEFAULT_MERGE_WINDOW = 100
+
+# Lines of an SSV matrix parsed at a time
+SSV_CHUNK_SIZE = 1_000_000
+
+
+def pair_index(i, j, n):
+    """Position of the pair (i, j), i < j, in a condensed array without the diagonal"""
+    return i * n - i * (i + 1) // 2 + j - i - 1
+
+
+def pair_indices(i, others, n):
+    """Positions of the pairs between i and an array of other positions"""
+    lo = np.minimum(i, others)
+    hi = np.maximum(i, others)
+    return pair_index(lo, hi, n)
+
+
+def load_binary_matrix(matrix_path):
+    """Label index and pair distances (no diagonal) of a binary matrix
+
+    Distances keep the stored float32 (float16 matrices are widened to
+    float32), half the memory of float64; the linkage updates of each merge
+    are computed in float64 and stored back.
+    """
+    matrix = CondensedDistanceMatrix(matrix_path)
+    n = matrix.n
+    distances = np.empty(
+        n * (n - 1) // 2, dtype=np.promote_types(matrix.array.dtype, np.float32)
+    )
+    for i in range(n - 1):
+        start = pair_index(i, i + 1, n)
+        distances[start : start + n - i - 1] = matrix.row(i)[1:]
+    return matrix.label_index, distances
+
+
+def iter_ssv_pairs(matrix_path, label_index):
+    """Yield (rows, cols, distances) arrays of the lines of an SSV matrix, chunk by chunk
+
+    gzip/zstd matrices are read through their .gz/.zst extension. An empty
+    file (i.e. the neighbours of a single label) yields nothing.
+    """
+    ssv_labels = pd.Index([f">{label}" for label in label_index])
+    try:
+        chunks = pd.read_csv(
+            matrix_path,
+            sep=" ",
+            header=None,
+            names=["label_a", "label_b", "distance"],
+            dtype={"label_a": str, "label_b": str, "distance": np.float64},
+            quoting=csv.QUOTE_NONE,
+            na_filter=False,
+            chunksize=SSV_CHUNK_SIZE,
+        )
+    except pd.errors.EmptyDataError:
+        return
+    for chunk in chunks:
+        rows = ssv_labels.get_indexer(chunk["label_a"])
+        cols = ssv_labels.get_indexer(chunk["label_b"])
+        unknown = (rows < 0) | (cols < 0)
+        if unknown.any():
+            first = chunk[unknown].iloc[0]
+            raise ValueError(
+                f"{matrix_path} has labels missing from the label index (i.e. {first['label_a']} {first['label_b']})"
+            )
+        yield rows.astype(np.int64), cols.astype(np.int64), chunk["distance"].values
+
+
+def load_ssv_matrix(matrix_path, label_index):
+    """Float64 pair distances (no diagonal) of an SSV matrix, dense or sparse
+
+    Pairs not in the file are at the default distance.
+    """
+    n = len(label_index)
+    distances = np.full(n * (n - 1) // 2, DEFAULT_DISTANCE, dtype=np.float64)
+    for rows, cols, values in iter_ssv_pairs(matrix_path, label_index):
+        lo = np.minimum(rows, cols)
+        hi = np.maximum(rows, cols)
+        pairs = lo != hi
+        distances[pair_index(lo[pairs], hi[pairs], n)] = values[pairs]
+    return distances
+
+
+def load_ssv_graph(matrix_path, label_index):
+    """Pairs (i < j) and distances listed in a sparse SSV neighbour file
+
+    Each pair is kept once. Pairs at or beyond the default distance are
+    dropped, as they are equivalent to unlisted ones.
+    """
+    n = len(label_index)
+    keys = [np.empty(0, dtype=np.int64)]
+    distances = [np.empty(0, dtype=np.float64)]
+    for rows, cols, values in iter_ssv_pairs(matrix_path, label_index):
+        lo = np.minimum(rows, cols)
+        hi = np.maximum(rows, cols)
+        listed = (lo != hi) & (values < DEFAULT_DISTANCE)
+        keys.append(lo[listed] * n + hi[listed])
+        distances.append(values[listed])
+    keys, first = np.unique(np.concatenate(keys), return_index=True)
+    if not len(keys) and n > 1:
+        LOG.warning(f"No neighbour pairs in {matrix_path}, all labels are joined at the default distance")
+    LOG.info(f"Read {len(keys)} neighbour pairs of {n} labels from {matrix_path}")
+    return keys // n, keys % n, np.concatenate(distances)[first]
+
+
+def lance_williams(linkage, d_a, d_b, size_a, size_b):
+    """Distances of a merged cluster a+b to other clusters from those of a and b"""
+    if linkage == "single":
+        return np.minimum(d_a, d_b)
+    if linkage == "complete":
+        return np.maximum(d_a, d_b)
+    return (size_a * d_a + size_b * d_b) / (size_a + size_b)
+
+
+def merge_slots(distances, n, linkage, active, sizes, a, b):
+    """Merge cluster a into b, updating the distances of b to the other active clusters"""
+    others = np.flatnonzero(active)
+    others = others[(others != a) & (others != b)]
+    index_a = pair_indices(a, others, n)
+    index_b = pair_indices(b, others, n)
+    distances[index_b] = lance_williams(
+        linkage, distances[index_a], distances[index_b], sizes[a], sizes[b]
+    )
+    active[a] = False
+    sizes[b] += sizes[a]
+
+
+def nn_chain_linkage(distances, n, linkage="average"):
+    """Agglomerate n leaves with the nearest-neighbour chain algorithm, in O(n²)
+
+    `distances` (condensed, without the diagonal) is updated in place with the
+    Lance-Williams formula of the linkage, so it is consumed by the build.
+    Returns the merges as a MergeTrace.
+    """
+    slots = np.arange(n, dtype=np.int64)
+    active = np.ones(n, dtype=bool)
+    sizes = np.ones(n, dtype=np.int64)
+    merges = []
+    chain = []
+    while len(merges) < n - 1:
+        if not chain:
+            chain.append(int(np.argmax(active)))
+        a = chain[-1]
+        others = slots[active]
+        others = others[others != a]
+        row = distances[pair_indices(a, others, n)]
+        nearest = int(np.argmin(row))
+        b, distance = int(others[nearest]), row[nearest]
+        # prefer the previous link of the chain on ties, so the chain cannot cycle
+        if len(chain) > 1:
+            previous = chain[-2]
+            previous_distance = distances[pair_index(min(a, previous), max(a, previous), n)]
+            if previous_distance <= distance:
+                b, distance = previous, previous_distance
+        if len(chain) > 1 and b == chain[-2]:
+            del chain[-2:]
+            merge_slots(distances, n, linkage, active, sizes, a, b)
+            merges.append((a, b, float(distance)))
+        else:
+            chain.append(b)
+    return MergeTrace.from_slot_merges(n, merges)
+
+
+def windowed_linkage(distances, n, linkage="average", merge_window=DEFAULT_MERGE_WINDOW):
+    """Agglomerate n leaves merging up to `merge_window` pairs per round
+
+    Each active cluster keeps its nearest neighbour, and a heap holds the
+    candidate pair of each cluster. A round pops the closest candidates and
+    merges every one not sharing a cluster with a closer candidate of the
+    round; such pairs are reciprocal nearest neighbours, so for these
+    (reducible) linkages the tree is the one of nn_chain_linkage, in far
+    fewer rounds. Only merged clusters and those whose nearest neighbour was
+    merged rescan their distances.
+    """
+    slots = np.arange(n, dtype=np.int64)
+    active = np.ones(n, dtype=bool)
+    sizes = np.ones(n, dtype=np.int64)
+    nearest = np.full(n, -1, dtype=np.int64)
+    nearest_distance = np.full(n, np.inf)
+    candidates = []
+
+    def update_nearest(i):
+        others = slots[active]
+        others = others[others != i]
+        row = distances[pair_indices(i, others, n)]
+        k = int(np.argmin(row))
+        nearest[i] = others[k]
+        nearest_distance[i] = row[k]
+        heapq.heappush(candidates, (float(row[k]), i, int(others[k])))
+
+    if n > 1:
+        for i in range(n):
+            update_nearest(i)
+    merges = []
+    rounds = 0
+    while len(merges) < n - 1:
+        rounds += 1
+        window = []
+        while candidates and len(window) < merge_window:
+            candidate = heapq.heappop(candidates)
+            distance, i, j = candidate
+            # skip candidates of merged clusters or superseded by a new neighbour
+            if active[i] and active[j] and nearest[i] == j and nearest_distance[i] == distance:
+                window.append(candidate)
+        merged = set()
+        # clusters of deferred candidates: their neighbourhood changes this round
+        deferred = set()
+        for candidate in window:
+            distance, i, j = candidate
+            if {i, j} & (merged | deferred):
+                deferred.update((i, j))
+                heapq.heappush(candidates, candidate)
+                continue
+            merge_slots(distances, n, linkage, active, sizes, i, j)
+            merges.append((i, j, distance))
+            merged.update((i, j))
+        if len(merges) == n - 1:
+            break
+        merged = list(merged)
+        for i in np.flatnonzero(active & (np.isin(nearest, merged) | np.isin(slots, merged))).tolist():
+            update_nearest(i)
+    LOG.info(f"Merged {n} starting clusters in {rounds} rounds")
+    return MergeTrace.from_slot_merges(n, merges)
+
+
+def sparse_single_linkage(n, rows, cols, distances):
+    """Exact single linkage of a neighbour graph, with union-find over the sorted edges"""
+    parent = list(range(n))
+
+    def find(slot):
+        while parent[slot] != slot:
+            parent[slot] = parent[parent[slot]]
+            slot = parent[slot]
+        return slot
+
+    merges = []
+    rows, cols, distances = rows.tolist(), cols.tolist(), distances.tolist()
+    for edge in np.argsort(distances, kind="stable").tolist():
+        root_a, root_b = find(rows[edge]), find(cols[edge])
+        if root_a != root_b:
+            parent[root_a] = root_b
+            merges.append((root_a, root_b, distances[edge]))
+    # unconnected components are at the default distance
+    roots = [slot for slot in range(n) if find(slot) == slot]
+    merges.extend((a, b, DEFAULT_DISTANCE) for a, b in zip(roots[:-1], roots[1:]))
+    return MergeTrace.from_slot_merges(n, merges)
+
+
+def sparse_pair_distance(linkage, stats, n_pairs):
+    """Linkage distance between two clusters from the (total, largest, count) of their listed pairs"""
+    total, largest, count = stats
+    if linkage == "complete":
+        return largest if count == n_pairs else DEFAULT_DISTANCE
+    return (total + (n_pairs - count) * DEFAULT_DISTANCE) / n_pairs
+
+
+def sparse_linkage(n, rows, cols, distances, linkage="average"):
+    """Agglomerate the n leaves of a neighbour graph, unlisted pairs being at the default distance
+
+    Each cluster keeps the (total, largest, count) of its listed pairs to each
+    neighbouring cluster, and a heap holds the linkage distance of each
+    neighbouring pair, so memory is proportional to the number of edges.
+    Clusters are numbered as trace nodes (from 0), so a heap entry is valid
+    as long as both its clusters are.
+    """
+    if linkage == "single":
+        return sparse_single_linkage(n, rows, cols, distances)
+    sizes = [1] * n
+    active = [True] * n
+    neighbours = [{} for _ in range(n)]
+    for i, j, distance in zip(rows.tolist(), cols.tolist(), distances.tolist()):
+        neighbours[i][j] = neighbours[j][i] = (distance, distance, 1)
+    n_edges = len(distances)
+
+    def live_candidates():
+        return [
+            (sparse_pair_distance(linkage, stats, sizes[a] * sizes[b]), a, b)
+            for a, cluster_neighbours in enumerate(neighbours)
+            if active[a]
+            for b, stats in cluster_neighbours.items()
+            if a < b
+        ]
+
+    candidates = live_candidates()
+    heapq.heapify(candidates)
+    pairs = []
+    merge_distances = []
+    while candidates:
+        distance, a, b = heapq.heappop(candidates)
+        if not (active[a] and active[b]):
+            continue
+        merged, other = neighbours[a], neighbours[b]
+        neighbours[a] = neighbours[b] = None
+        del merged[b], other[a]
+        if len(merged) < len(other):
+            merged, other = other, merged
+        for k, stats in other.items():
+            if k in merged:
+                total, largest, count = merged[k]
+                merged[k] = (total + stats[0], max(largest, stats[1]), count + stats[2])
+            else:
+                merged[k] = stats
+        c = len(sizes)
+        sizes.append(sizes[a] + sizes[b])
+        active[a] = active[b] = False
+        active.append(True)
+        neighbours.append(merged)
+        for k, stats in merged.items():
+            neighbour_stats = neighbours[k]
+            neighbour_stats.pop(a, None)
+            neighbour_stats.pop(b, None)
+            neighbour_stats[c] = stats
+            heapq.heappush(
+                candidates,
+                (sparse_pair_distance(linkage, stats, sizes[c] * sizes[k]), c, k),
+            )
+        pairs.append((b + 1, a + 1) if b < a else (a + 1, b + 1))
+        merge_distances.append(distance)
+        # drop the entries of merged clusters once they outnumber the edges
+        if len(candidates) > 2 * n_edges + n:
+            candidates = live_candidates()
+            heapq.heapify(candidates)
+    # unconnected clusters are at the default distance
+    remaining = [c for c, is_active in enumerate(active) if is_active]
+    if remaining:
+        node = remaining[0]
+        for other in remaining[1:]:
+            pairs.append(tuple(sorted((node + 1, other + 1))))
+            merge_distances.append(DEFAULT_DISTANCE)
+            node = n + len(pairs) - 1
+    return MergeTrace(n, pairs, merge_distances)
+
+
+def build_linkage(distances, n, linkage="average", tree_builder="nn_chain", merge_window=DEFAULT_MERGE_WINDOW):
+    if tree_builder == "windowed":
+        return windowed_linkage(distances, n, linkage, merge_window)
+    return nn_chain_linkage(distances, n, linkage)
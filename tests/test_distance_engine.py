@@ -0,0 +1,130 @@
+import numpy as np
+import pytest
+import torch
+from cath_emma.commands.create_distance_tiles import compute_tile, init_tile_worker
+from cath_emma.distance_engine import DEFAULT_DISTANCE, BlockedDistanceEngine
+from cath_emma.matrix_io import CondensedDistanceMatrix, CondensedMatrixWriter
+from cath_emma.matrix_tiles import (
+    iter_merged_row_bands,
+    upper_triangle_tiles,
+    write_tile_layout,
+)
+
+
+def naive_distance(a, b, metric):
+    a, b = a.to(torch.float64), b.to(torch.float64)
+    if metric == "cosine":
+        return float(1 - a @ b / (a.norm() * b.norm()))
+    return float((a - b).norm())
+
+
+def dense_upper(bands, n):
+    """Full upper triangle (diagonal included) from (start, band) pairs"""
+    matrix = np.full((n, n), np.nan)
+    for start, band in bands:
+        for offset in range(band.shape[0]):
+            i = start + offset
+            matrix[i, i:] = band[offset, i:]
+    return matrix
+
+
+@pytest.fixture
+def embeddings():
+    return torch.randn(23, 16, generator=torch.Generator().manual_seed(0))
+
+
+@pytest.mark.parametrize("metric", ["euclidean", "cosine"])
+def test_row_bands_match_naive_distances(embeddings, metric):
+    positions = np.array([0, 1, -1] + list(range(2, 23)), dtype=np.int64)
+    engine = BlockedDistanceEngine(embeddings, metrics=[metric], tile_size=5)
+    matrix = dense_upper(
+        ((start, bands[0]) for start, bands in engine.iter_row_bands(positions)),
+        len(positions),
+    )
+    for i in range(len(positions)):
+        for j in range(i, len(positions)):
+            if positions[i] < 0 or positions[j] < 0:
+                expected = DEFAULT_DISTANCE
+            elif i == j:
+                expected = 0.0
+            else:
+                expected = naive_distance(embeddings[positions[i]], embeddings[positions[j]], metric)
+            assert matrix[i, j] == pytest.approx(expected, abs=1e-5)
+
+
+def test_nearest_neighbours_match_naive(embeddings):
+    distances, neighbours = BlockedDistanceEngine(embeddings, tile_size=4).nearest_neighbours(3)
+    for i in range(len(embeddings)):
+        naive = sorted(
+            (naive_distance(embeddings[i], embeddings[j], "euclidean"), j)
+            for j in range(len(embeddings))
+            if j != i
+        )[:3]
+        assert neighbours[i].tolist() == [j for _, j in naive]
+        np.testing.assert_allclose(distances[i], [d for d, _ in naive], rtol=1e-5)
+
+
+def test_nearest_neighbours_of_a_single_row():
+    distances, neighbours = BlockedDistanceEngine(torch.ones(1, 4)).nearest_neighbours(5)
+    assert distances.shape == neighbours.shape == (1, 0)
+    with pytest.raises(ValueError):
+        BlockedDistanceEngine(torch.ones(3, 4)).nearest_neighbours(0)
+
+
+def test_incremental_update_equals_full_recompute(tmp_path, embeddings):
+    previous_labels = [f"l{i}" for i in range(18)]
+    previous_path = str(tmp_path / "previous.npy")
+    writer = CondensedMatrixWriter(previous_path, previous_labels)
+    engine = BlockedDistanceEngine(embeddings[:18], tile_size=4)
+    for start, bands in engine.iter_row_bands(np.arange(18)):
+        writer.write_band(start, bands[0])
+    writer.close()
+    previous = CondensedDistanceMatrix(previous_path)
+
+    # reordered labels, a dropped one, a changed embedding, new and missing labels
+    updated = embeddings.clone()
+    updated[4] += 1
+    labels = ["l7", "l3", "l4", "new19", "l0", "missing", "l12", "l1", "new20"] + [
+        f"l{i}" for i in (2, 5, 6, 8, 9, 10, 11, 13, 14, 15, 16)
+    ]
+    rows = {**{f"l{i}": i for i in range(18)}, "new19": 19, "new20": 20}
+    positions = np.array([rows.get(label, -1) for label in labels], dtype=np.int64)
+    previous_positions = np.array(
+        [
+            previous.index(label) if label in previous.label_index and label != "l4" else -1
+            for label in labels
+        ],
+        dtype=np.int64,
+    )
+    engine = BlockedDistanceEngine(updated, tile_size=4)
+    full = dense_upper(
+        ((start, bands[0]) for start, bands in engine.iter_row_bands(positions)),
+        len(labels),
+    )
+    incremental = dense_upper(
+        (
+            (start, bands[0])
+            for start, bands in engine.iter_updated_row_bands(
+                positions, [previous], previous_positions
+            )
+        ),
+        len(labels),
+    )
+    np.testing.assert_allclose(incremental, full, atol=1e-5)
+
+
+def test_tiles_merge_into_the_single_pass_matrix(tmp_path, embeddings):
+    labels = [f"l{i}" for i in range(len(embeddings) + 1)]
+    positions = np.array(list(range(len(embeddings))) + [-1], dtype=np.int64)
+    tile_dir = str(tmp_path / "tiles")
+    write_tile_layout(tile_dir, labels, 5, "euclidean")
+    init_tile_worker(embeddings, positions, "euclidean", 5, tile_dir)
+    for tile in upper_triangle_tiles(len(labels), 5):
+        compute_tile(tile)
+    engine = BlockedDistanceEngine(embeddings, tile_size=5)
+    single_pass = dense_upper(
+        ((start, bands[0]) for start, bands in engine.iter_row_bands(positions)),
+        len(labels),
+    )
+    merged = dense_upper(iter_merged_row_bands(tile_dir), len(labels))
+    np.testing.assert_array_equal(merged, single_pass)
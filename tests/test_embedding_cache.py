@@ -0,0 +1,33 @@
+import torch
+from cath_emma.embedding_cache import EmbeddingCache, sequence_md5
+
+
+def test_sequence_md5_is_case_insensitive():
+    assert sequence_md5("mkv") == sequence_md5("MKV") == "bc5a0dfbf35ec22ac2c0f8c1e5534d8e"
+
+
+def test_round_trip_per_model_layer_and_pooling(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = EmbeddingCache(path, "esm", 33, "mean")
+    embeddings = {sequence_md5(s): torch.randn(6) for s in ("MKV", "MKL")}
+    cache.put_many(embeddings)
+    found = cache.get_many([*embeddings, sequence_md5("AAA")])
+    assert found.keys() == embeddings.keys()
+    for md5, embedding in embeddings.items():
+        torch.testing.assert_close(found[md5], embedding)
+    cache.close()
+    assert EmbeddingCache(path, "esm", 12, "mean").get_many(embeddings) == {}
+    assert len(EmbeddingCache(path, "esm", 33, "mean").get_many(embeddings)) == 2
+
+
+def test_eviction_keeps_the_recently_used_within_max_bytes(tmp_path):
+    vector_bytes = 4 * 8
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"), "esm", 33, "mean", max_bytes=10 * vector_bytes)
+    md5s = [f"{k:032x}" for k in range(30)]
+    for k, md5 in enumerate(md5s):
+        cache.put_many({md5: torch.full((8,), float(k))})
+        # keep the first embedding in use
+        cache.get_many(md5s[:1])
+        assert cache.size_bytes() <= 10 * vector_bytes
+    assert set(cache.get_many(md5s)) >= {md5s[0], md5s[-1]}
+    assert len(cache.get_many(md5s)) <= 10
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import torch
+from cath_emma.embedding_shards import (
+    consolidate_shards,
+    open_manifest,
+    shard_ranges,
+    write_shard,
+)
+from cath_emma.embedding_store import EmbeddingStore, EmbeddingStoreWriter
+
+LAYOUT = {"n_sequences": 5, "shard_size": 2}
+
+
+def embedding(label, k):
+    return {"label": label, "mean_representations": {33: torch.full((4,), float(k))}}
+
+
+def write_shards(shard_dir, shards):
+    manifest = open_manifest(shard_dir, LAYOUT)
+    for shard in shards:
+        start, stop = shard_ranges(5, 2)[shard]
+        write_shard(shard_dir, manifest, shard, [embedding(f"l{k}", k) for k in range(start, stop)])
+
+
+def test_consolidation_needs_every_shard(tmp_path):
+    shard_dir = str(tmp_path / "shards")
+    write_shards(shard_dir, [0, 2])
+    with pytest.raises(FileNotFoundError):
+        consolidate_shards(shard_dir, str(tmp_path / "embeddings.pt"))
+    with pytest.raises(ValueError):
+        open_manifest(shard_dir, {**LAYOUT, "shard_size": 3})
+
+
+@pytest.mark.parametrize("embeddings_format", ["pt", "npy"])
+def test_resumed_shards_consolidate_in_input_order(tmp_path, embeddings_format):
+    shard_dir = str(tmp_path / "shards")
+    write_shards(shard_dir, [2, 0])
+    # a rerun resumes from the manifest
+    write_shards(shard_dir, [1])
+    output = str(tmp_path / f"embeddings.{embeddings_format}")
+    assert consolidate_shards(shard_dir, output, embeddings_format) == 5
+    if embeddings_format == "pt":
+        embeddings = torch.load(output)
+        assert [e["label"] for e in embeddings] == [f"l{k}" for k in range(5)]
+        vectors = np.stack([e["mean_representations"][33].numpy() for e in embeddings])
+    else:
+        store = EmbeddingStore(output)
+        assert store.labels == [f"l{k}" for k in range(5)]
+        vectors = store.rows(slice(None)).numpy()
+    np.testing.assert_array_equal(vectors, np.repeat(np.arange(5.0), 4).reshape(5, 4))
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_empty_store_is_not_written(tmp_path):
+    store_path = tmp_path / "embeddings.npy"
+    with pytest.raises(ValueError):
+        EmbeddingStoreWriter(str(store_path), []).close()
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,33 @@
+import io
+import numpy as np
+from cath_emma.distance_engine import DEFAULT_DISTANCE
+from cath_emma.foldseek import FoldseekHits
+from cath_emma.label_index import LabelIndex
+
+M8 = """\
+a b 0.5 10 0 0 1 10 1 10 1e-5 4
+b a 0.5 10 0 0 1 10 1 10 1e-5 5
+c a 0.5 10 0 0 1 10 1 10 1e-5 8
+a d 0.5 10 0 0 1 10 1 10 1e-5 2
+a d 0.5 10 0 0 1 10 1 10 1e-5 20
+b c 0.5 10 0 0 1 10 1 10 1e-5 0
+a a 0.5 10 0 0 1 10 1 10 1e-5 99
+a unknown 0.5 10 0 0 1 10 1 10 1e-5 99
+"""
+
+
+def test_from_m8_keeps_one_hit_per_pair():
+    hits = FoldseekHits.from_m8(io.StringIO(M8), LabelIndex(["a", "b", "c", "d"]))
+    pairs = dict(zip(zip(hits.rows.tolist(), hits.cols.tolist()), hits.bitscores.tolist()))
+    # a -> b wins over b -> a, the reverse c -> a is the only a/c hit, the last a -> d hit wins
+    assert pairs == {(0, 1): 4, (0, 2): 8, (0, 3): 20, (1, 2): 0}
+
+
+def test_row_bands_match_naive_distances():
+    hits = FoldseekHits.from_m8(io.StringIO(M8), LabelIndex(["a", "b", "c", "d", "e"]))
+    expected = np.full((5, 5), DEFAULT_DISTANCE, dtype=np.float64)
+    np.fill_diagonal(expected, 0.0)
+    expected[0, 1], expected[0, 2], expected[0, 3] = 1 / 4, 1 / 8, 1 / 20
+    for band_size in (1, 2, 5):
+        bands = np.concatenate([band for _, band in hits.iter_row_bands(band_size)])
+        np.testing.assert_array_equal(np.triu(bands), np.triu(expected))
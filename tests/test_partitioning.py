@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+import torch
+from cath_emma.partitioning import pair_distances, partition_rows, partitioned_linkage
+from cath_emma.tree_builder import nn_chain_linkage
+
+
+@pytest.fixture
+def embeddings():
+    generator = torch.Generator().manual_seed(0)
+    centres = 10 * torch.randn(4, 8, generator=generator)
+    return centres.repeat_interleave(10, dim=0) + torch.randn(40, 8, generator=generator)
+
+
+def test_partitions_cover_the_rows_within_max_size(embeddings):
+    partitions = partition_rows(embeddings.numpy(), max_size=7)
+    assert all(len(rows) <= 7 for rows in partitions)
+    assert sorted(np.concatenate(partitions).tolist()) == list(range(40))
+
+
+def test_identical_rows_are_split():
+    partitions = partition_rows(np.ones((10, 3), dtype=np.float32), max_size=4)
+    assert [len(rows) for rows in partitions] == [4, 3, 3]
+
+
+@pytest.mark.parametrize("metric", ["euclidean", "cosine"])
+def test_single_partition_is_the_exact_tree(embeddings, metric):
+    positions = np.arange(40)
+    trace, partition_of_label = partitioned_linkage(embeddings, positions, metric, max_size=40)
+    exact = nn_chain_linkage(pair_distances(embeddings, metric), 40)
+    assert (partition_of_label == 0).all()
+    np.testing.assert_array_equal(trace.pairs, exact.pairs)
+    np.testing.assert_allclose(trace.distances, exact.distances)
+
+
+def test_partitioned_tree_is_monotone_and_joins_missing_labels(embeddings):
+    positions = np.concatenate([np.arange(40), [-1, -1]])
+    trace, partition_of_label = partitioned_linkage(embeddings, positions, max_size=12)
+    assert trace.n_leaves == 42 and len(trace) == 41
+    assert partition_of_label[-2:].tolist() == [-1, -1]
+    heights = [trace.height(node) for node in range(43, 84)]
+    for (node_a, node_b), height in zip(trace.pairs.tolist(), heights):
+        assert height >= trace.height(node_a) and height >= trace.height(node_b)
@@ -0,0 +1,104 @@
+import io
+import numpy as np
+import pytest
+from cath_emma.merge_trace import MergeTrace
+from cath_emma.tree_builder import (
+    LINKAGES,
+    build_linkage,
+    pair_index,
+    sparse_linkage,
+)
+
+
+def random_distances(n, seed=0):
+    """Condensed pair distances (no diagonal) of random points, without ties"""
+    points = np.random.default_rng(seed).random((n, 3))
+    rows, cols = np.triu_indices(n, k=1)
+    return np.linalg.norm(points[rows] - points[cols], axis=1)
+
+
+def naive_linkage(distances, n, linkage):
+    """Clusters and heights of each merge by recomputing every cluster distance, in O(n^3)"""
+    combine = {"average": np.mean, "single": np.min, "complete": np.max}[linkage]
+    clusters = [frozenset([leaf]) for leaf in range(n)]
+    merges = []
+    while len(clusters) > 1:
+        best = None
+        for a in range(len(clusters)):
+            for b in range(a + 1, len(clusters)):
+                distance = combine(
+                    [distances[pair_index(min(i, j), max(i, j), n)] for i in clusters[a] for j in clusters[b]]
+                )
+                if best is None or distance < best[0]:
+                    best = (distance, a, b)
+        distance, a, b = best
+        merged = clusters[a] | clusters[b]
+        clusters = [cluster for k, cluster in enumerate(clusters) if k not in (a, b)] + [merged]
+        merges.append((merged, distance))
+    return merges
+
+
+def trace_merges(trace):
+    return [
+        (frozenset(leaf - 1 for leaf in leaves), trace.height(node))
+        for node, leaves in trace.iter_merge_members()
+    ]
+
+
+def assert_same_tree(trace, expected):
+    merges = trace_merges(trace)
+    assert [members for members, _ in merges] == [members for members, _ in expected]
+    np.testing.assert_allclose([h for _, h in merges], [h for _, h in expected], rtol=1e-9)
+
+
+@pytest.mark.parametrize("linkage", LINKAGES)
+@pytest.mark.parametrize("tree_builder", ["nn_chain", "windowed"])
+def test_dense_builders_match_naive_linkage(linkage, tree_builder):
+    n = 30
+    distances = random_distances(n)
+    expected = naive_linkage(distances, n, linkage)
+    trace = build_linkage(distances.copy(), n, linkage, tree_builder, merge_window=4)
+    assert_same_tree(trace, expected)
+
+
+@pytest.mark.parametrize("linkage", LINKAGES)
+def test_sparse_builder_of_a_complete_graph_matches_naive_linkage(linkage):
+    n = 25
+    distances = random_distances(n, seed=1)
+    rows, cols = np.triu_indices(n, k=1)
+    trace = sparse_linkage(n, rows, cols, distances, linkage)
+    assert_same_tree(trace, naive_linkage(distances, n, linkage))
+
+
+def test_trace_round_trip():
+    trace = build_linkage(random_distances(12), 12)
+    trace_fh = io.StringIO()
+    trace.write(trace_fh)
+    trace_fh.seek(0)
+    read = MergeTrace.read(trace_fh)
+    assert read.n_leaves == 12
+    np.testing.assert_array_equal(read.pairs, trace.pairs)
+    np.testing.assert_allclose(read.distances, trace.distances, rtol=1e-7)
+
+
+def test_cut_matches_merges_at_or_below_threshold():
+    n = 20
+    trace = build_linkage(random_distances(n, seed=2), n)
+    thresholds = [0.0, 0.2, 0.4, 10.0]
+    for threshold, clusters in zip(thresholds, trace.cut(thresholds)):
+        expected = [frozenset([leaf]) for leaf in range(n)]
+        for members, height in trace_merges(trace):
+            if height <= threshold:
+                expected = [c for c in expected if not c <= members] + [members]
+        assert sorted(map(sorted, expected)) == sorted(
+            sorted(np.flatnonzero(clusters == cluster).tolist()) for cluster in set(clusters.tolist())
+        )
+        # numbered from 1 in order of their first leaf
+        firsts = [int(np.argmax(clusters == cluster)) for cluster in range(1, clusters.max() + 1)]
+        assert firsts == sorted(firsts)
+
+
+def test_cut_below_an_inversion_keeps_clades():
+    # leaves 1 and 2 merge at 5 into node 4, then node 4 and leaf 3 at 3
+    trace = MergeTrace(3, [(1, 2), (3, 4)], [5.0, 3.0])
+    assert trace.cut([2.0, 4.0]).tolist() == [[1, 2, 3], [1, 1, 1]]